@@ -0,0 +1,82 @@
+"""
+Chunked, concurrent eth_getLogs catch-up over a range of blocks.
+"""
+
+import asyncio
+import collections
+import logging
+
+from executor import RPC
+
+
+logger = logging.getLogger(__name__)
+
+
+class Backfiller:
+    """
+    Fetches the logs of `[from_block, to_block]` in block ranges, with up
+    to `concurrency` requests in flight. If the node refuses a range (too
+    many results, a timeout, a range limit), the range is split in halves
+    and the chunk size shrinks. Each successful full chunk grows it again.
+
+    Ranges are passed to `deliver(logs, last_block)` strictly in order, with
+    the logs sorted by (block, log index). So `last_block` is safe to
+    checkpoint once `deliver` returns. `w3` overrides the one given at
+    construction for a single run.
+    """
+
+    MAX_RETRIES = 3
+
+    def __init__(self, w3, executor, address: str, topics, chunk: int = 2000,
+                 max_chunk: int = 5000, concurrency: int = 4):
+        self.w3 = w3
+        self.executor = executor
+        self.address = address
+        self.topics = topics
+        self.chunk = chunk
+        self.max_chunk = max_chunk
+        self.concurrency = concurrency
+
+    async def run(self, from_block: int, to_block: int, deliver, w3=None):
+        w3 = w3 or self.w3
+        in_flight = collections.deque()
+        start = from_block
+        while start <= to_block or in_flight:
+            while start <= to_block and len(in_flight) < self.concurrency:
+                end = min(to_block, start + self.chunk - 1)
+                in_flight.append((end, asyncio.ensure_future(self.fetch(w3, start, end))))
+                start = end + 1
+            end, task = in_flight.popleft()
+            try:
+                logs = await task
+            except BaseException:
+                for _, other in in_flight:
+                    other.cancel()
+                raise
+            logs.sort(key=lambda log: (log["blockNumber"], log["logIndex"]))
+            logger.info("Backfilled up to block %d of %d: %d logs", end, to_block, len(logs))
+            await deliver(logs, end)
+
+    async def fetch(self, w3, start: int, end: int, attempt: int = 0):
+        params = {
+            "address": self.address,
+            "fromBlock": start,
+            "toBlock": end,
+            "topics": self.topics,
+        }
+        try:
+            logs = await self.executor.run(RPC, w3.eth.getLogs, params)
+        except Exception as e:
+            if start == end:
+                if attempt + 1 >= self.MAX_RETRIES:
+                    raise
+                logger.warning("getLogs for block %d failed (%s), retrying", start, e)
+                await asyncio.sleep(2 ** attempt)
+                return await self.fetch(w3, start, end, attempt + 1)
+            self.chunk = max(1, min(self.chunk, (end - start + 1) // 2))
+            logger.warning("getLogs %d..%d failed (%s), splitting, chunk=%d", start, end, e, self.chunk)
+            middle = (start + end) // 2
+            return await self.fetch(w3, start, middle) + await self.fetch(w3, middle + 1, end)
+        if end - start + 1 >= self.chunk:
+            self.chunk = min(self.max_chunk, self.chunk + self.chunk // 4 + 1)
+        return list(logs)
@@ -0,0 +1,62 @@
+"""
+Latency comparison: a fresh RequestClient per call (the old `@client`
+behaviour) against the pooled client from `ClientRegistry`.
+
+    $ python -m benchmarks.client_pool config.yaml --calls 20
+"""
+
+import argparse
+import statistics
+import time
+
+import yaml
+from binance_f import RequestClient
+
+from binance_wrappers import ClientRegistry
+
+
+def fresh_client(config):
+    return RequestClient(
+        api_key=config["API_Key"],
+        secret_key=config["Secret_Key"],
+        url=config["URL"],
+    )
+
+
+def measure(get_client, config, calls):
+    timings = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        get_client(config).get_servertime()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(
+        f"{name:>8}: mean={statistics.mean(timings):8.2f}ms "
+        f"p50={statistics.median(timings):8.2f}ms p95={p95:8.2f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", type=open)
+    parser.add_argument("--calls", type=int, default=20)
+    ns = parser.parse_args()
+    config = yaml.load(ns.config, Loader=yaml.FullLoader)["binance"]
+
+    report("fresh", measure(fresh_client, config, ns.calls))
+
+    registry = ClientRegistry()
+    try:
+        registry.get(config).get_servertime()  # warm the pool up
+        report("pooled", measure(registry.get, config, ns.calls))
+    finally:
+        registry.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Decoding cost of a batch of BetPlaced logs: the per-event path that
+`EventProvider.process_result` used to run (struct unpacking, an ORM `Bet`
+and an index row per log) against `decoder.decode_logs`.
+
+    $ python -m benchmarks.decode --logs 2000 --rounds 20 [--info]
+
+With --info, logging is enabled at INFO into a null handler, as in
+production, where the old path formatted every log and every bet.
+"""
+
+import argparse
+import datetime
+import logging
+import random
+import statistics
+import struct
+import time
+
+from hexbytes import HexBytes
+from web3.datastructures import AttributeDict
+
+from decoder import BET_PLACED_TOPIC, LIFECYCLE_TOPICS, decode_logs
+from models import Bet, EventKind
+
+
+logger = logging.getLogger(__name__)
+
+
+def decode_event(event) -> Bet:
+    bet_id_raw, user = event.topics[1:3]
+    user = user[-20:]
+    bet_id = 0
+    for bet_id_8b_chunk in struct.unpack('>4Q', bet_id_raw):
+        bet_id = bet_id * 2**64 + bet_id_8b_chunk
+    data_offset = 2  # to adjust 0x
+    next_field_size = 64
+    direction = int(event.data[data_offset:data_offset+next_field_size], 16)
+    data_offset += next_field_size
+    next_field_size = 64
+    amount = HexBytes(event.data[data_offset:data_offset+next_field_size])
+    res = dict(id=bet_id, tx=event.transactionHash, sender=user, amount=amount,
+               created=datetime.datetime.utcnow(), direction=direction)
+    logger.info('Received Bet %s', res)
+    return Bet(**res)
+
+
+def per_event(result):
+    logger.info('processing %s', result)
+    bets = {}
+    index_rows = []
+    for event in result:
+        kind = LIFECYCLE_TOPICS[HexBytes(event.topics[0])]
+        index_rows.append(dict(
+            block=event.blockNumber, log_index=event.logIndex, kind=kind.value,
+            bet_id=int.from_bytes(event.topics[1], "big"), tx=event.transactionHash,
+        ))
+        if kind != EventKind.PLACED:
+            continue
+        bet = decode_event(event)
+        bets.setdefault(bet.id, bet)
+    return bets, index_rows
+
+
+def batched(result):
+    batch = decode_logs(result)
+    logger.info("Processing %d logs, %d bets placed", len(batch), len(batch.placed))
+    bets = {}
+    for bet in batch.placed:
+        bets.setdefault(bet.id, bet)
+    return bets, batch.index_rows()
+
+
+def make_logs(count, seed=1):
+    rng = random.Random(seed)
+    logs = []
+    for i in range(count):
+        direction = rng.randint(0, 1)
+        amount = rng.randint(10**16, 10**20)
+        logs.append(AttributeDict({
+            "address": "0x" + "11" * 20,
+            "topics": [
+                HexBytes(BET_PLACED_TOPIC),
+                HexBytes((1000 + i).to_bytes(32, "big")),
+                HexBytes(bytes(12) + rng.randbytes(20)),
+            ],
+            "data": "0x" + direction.to_bytes(32, "big").hex() + amount.to_bytes(32, "big").hex(),
+            "blockNumber": 10_000_000 + i // 10,
+            "logIndex": i % 10,
+            "transactionHash": HexBytes(rng.randbytes(32)),
+        }))
+    return logs
+
+
+def measure(fn, logs, rounds):
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        fn(logs)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def report(name, timings, count):
+    mean = statistics.mean(timings)
+    print(f"{name:>9}: mean={mean:8.2f}ms p50={statistics.median(timings):8.2f}ms "
+          f"per log={mean * 1000 / count:6.2f}us")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logs", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--info", action="store_true")
+    ns = parser.parse_args()
+    if ns.info:
+        logging.basicConfig(level=logging.INFO, handlers=[logging.NullHandler()])
+
+    logs = make_logs(ns.logs)
+    old_bets, old_rows = per_event(logs)
+    new_bets, new_rows = batched(logs)
+    assert old_rows == new_rows
+    assert all(
+        (old.id, old.direction, bytes(old.amount), bytes(old.sender)) ==
+        (new.id, new.direction, new.amount, new.sender)
+        for old, new in zip(old_bets.values(), new_bets.values())
+    )
+
+    report("per-event", measure(per_event, logs, ns.rounds), ns.logs)
+    report("batched", measure(batched, logs, ns.rounds), ns.logs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+End-to-end benchmark: `main.main` against the local fakes of Binance
+futures and of a BSC node, no network needed.
+
+Bursts of BetPlaced events are mined on the fake chain; the bot runs as it
+does in production, in its own process, until every bet is hedged (both
+SL/TP legs on the fake exchange) and its betAccepted is sent, then it is
+interrupted. Reported: latency from the block being mined to the hedge and
+to betAccepted, throughput, exchange/RPC requests per bet, and the mean
+time to each stage as the bot's own metrics endpoint has it.
+
+    $ python -m benchmarks.e2e --bursts 5 --burst-size 20 --exchange-latency 0.02
+
+Exits with 1 if some bets were not hedged within `--timeout` seconds.
+"""
+
+import argparse
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import yaml
+from eth_account import Account
+from sqlalchemy import create_engine
+
+from benchmarks.fakes import FakeChain, FakeExchange
+from models import Base
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONTRACT = "0x295B855E8AD2316762Ea8Db12770e9A821f13DE6"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_config(workdir, ns, chain, exchange, metrics_port):
+    account = Account.create()
+    db_path = os.path.join(workdir, "bets.sqlite")
+    Base.metadata.create_all(create_engine(f"sqlite:///{db_path}"))
+    config = {
+        "incoming": {
+            "rpc": [chain.url],
+            "rate_limits": [],
+            "contract": CONTRACT,
+            "first_block": 0,
+            "ingestion": "blocks",
+            "confirmations": 0,
+        },
+        "rewards": {
+            "rpc": [chain.url],
+            "contract": CONTRACT,
+            "private_key": account.key.hex(),
+            "sender_address": account.address,
+            "gas_price_gwei": 10,
+        },
+        "binance": {
+            "URL": exchange.url,
+            "API_Key": "benchmark",
+            "Secret_Key": "benchmark",
+            "leverage": 20,
+            "batch_stoppers": True,
+            "user_stream": False,
+        },
+        "db": {
+            "conn": f"sqlite:///{db_path}",
+            "journal": os.path.join(workdir, "journal.sqlite"),
+        },
+        "algo": {
+            "safebelt-trigger": 1.5,
+            "win-trigger": 2.5,
+            "timeout-seconds": 3600,
+            "concurrency": ns.concurrency,
+        },
+        "metrics": {"port": metrics_port},
+    }
+    path = os.path.join(workdir, "config.yml")
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+def percentiles(name, started, finished):
+    latencies = sorted((finished[bet_id] - started[bet_id]) * 1000 for bet_id in finished if bet_id in started)
+    if not latencies:
+        print(f"{name:>14}: no samples")
+        return
+
+    def at(q):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+
+    print(
+        f"{name:>14}: p50={at(0.5):8.1f}ms p90={at(0.9):8.1f}ms p99={at(0.99):8.1f}ms "
+        f"max={latencies[-1]:8.1f}ms ({len(latencies)} bets)"
+    )
+
+
+def scrape_stages(metrics_port):
+    """ stage -> (mean seconds, count) from the bot's bet_stage_seconds histogram. """
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=5) as response:
+            text = response.read().decode()
+    except OSError:
+        return {}
+    found = {}
+    for kind, stage, value in re.findall(r'^bet_stage_seconds_(sum|count)\{stage="(\w+)"\} (\S+)$', text, re.M):
+        found.setdefault(stage, {})[kind] = float(value)
+    return {stage: (values["sum"] / values["count"], int(values["count"]))
+            for stage, values in found.items() if values.get("count")}
+
+
+def report(ns, chain, exchange, bet_ids, elapsed, stages):
+    hedged = [bet_id for bet_id in bet_ids if bet_id in exchange.legs_placed]
+    accepted = [bet_id for bet_id in bet_ids if bet_id in chain.accepted]
+    print(f"bets: {len(bet_ids)} placed, {len(hedged)} hedged, {len(accepted)} accepted in {elapsed:.1f}s")
+    percentiles("to hedge", chain.visible, exchange.legs_placed)
+    percentiles("to betAccepted", chain.visible, chain.accepted)
+    if hedged:
+        first = min(chain.visible[bet_id] for bet_id in hedged)
+        last = max(exchange.legs_placed[bet_id] for bet_id in hedged)
+        print(f"{'throughput':>14}: {len(hedged) / max(last - first, 1e-9):.1f} bets/s")
+    for stage, (mean, count) in stages.items():
+        print(f"{stage:>14}: mean={mean * 1000:8.1f}ms after the block was seen ({count} bets)")
+    for name, fake in (("exchange", exchange), ("rpc", chain)):
+        total = sum(fake.requests.values())
+        print(f"{name:>14}: {total} requests, {total / len(bet_ids):.2f} per bet")
+        if ns.verbose:
+            for endpoint, count in fake.requests.most_common():
+                print(f"{'':>16}{count:6d} {endpoint}")
+    return len(hedged) == len(accepted) == len(bet_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bursts", type=int, default=5)
+    parser.add_argument("--burst-size", type=int, default=20, help="bets mined in the same block")
+    parser.add_argument("--burst-interval", type=float, default=2.0, help="seconds between bursts")
+    parser.add_argument("--block-time", type=float, default=0.5)
+    parser.add_argument("--exchange-latency", type=float, default=0.0, help="seconds added to every REST call")
+    parser.add_argument("--rpc-latency", type=float, default=0.0, help="seconds added to every JSON-RPC call")
+    parser.add_argument("--leg-fill-rate", type=float, default=0.0,
+                        help="chance of an open SL/TP leg filling at each open orders scan")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=float, default=3.0, help="seconds for the bot to start before the bursts")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--keep", action="store_true", help="keep the work directory with the bot's log")
+    parser.add_argument("--verbose", action="store_true", help="requests by endpoint")
+    ns = parser.parse_args()
+
+    exchange = FakeExchange(latency=ns.exchange_latency, leg_fill_rate=ns.leg_fill_rate).start()
+    chain = FakeChain(CONTRACT, block_time=ns.block_time, latency=ns.rpc_latency).start()
+    workdir = tempfile.mkdtemp(prefix="e2e-")
+    metrics_port = free_port()
+    config_path = write_config(workdir, ns, chain, exchange, metrics_port)
+    log_path = os.path.join(workdir, "bot.log")
+    with open(log_path, "w") as log:
+        bot = subprocess.Popen([sys.executable, "main.py", config_path], cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+    bet_ids = []
+    try:
+        time.sleep(ns.warmup)
+        started = time.monotonic()
+        next_id = 1
+        for burst in range(ns.bursts):
+            if bot.poll() is not None:
+                break
+            bets = [(bet_id, bet_id % 2, 10 ** 17) for bet_id in range(next_id, next_id + ns.burst_size)]
+            chain.place_bets(bets)
+            bet_ids.extend(bet_id for bet_id, _, _ in bets)
+            next_id += ns.burst_size
+            time.sleep(ns.burst_interval)
+        deadline = started + ns.timeout
+        while time.monotonic() < deadline and bot.poll() is None:
+            if all(bet_id in chain.accepted and bet_id in exchange.legs_placed for bet_id in bet_ids):
+                break
+            time.sleep(0.1)
+        elapsed = time.monotonic() - started
+        stages = scrape_stages(metrics_port)
+    finally:
+        if bot.poll() is None:
+            bot.send_signal(signal.SIGINT)
+            try:
+                bot.wait(10)
+            except subprocess.TimeoutExpired:
+                bot.kill()
+        chain.stop()
+        exchange.stop()
+
+    if bot.returncode not in (0, -signal.SIGINT, 1) or not bet_ids:
+        print(f"bot exited with {bot.returncode}, see {log_path}")
+    complete = report(ns, chain, exchange, bet_ids, elapsed, stages) if bet_ids else False
+    if ns.keep or not complete:
+        print(f"bot log: {log_path}")
+    sys.exit(0 if complete else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,473 @@
+"""
+Local stand-ins for the Binance futures REST API, its mark price stream and
+for a BSC JSON-RPC node, good enough to run `main.main` against them without
+a network.
+
+Both servers count their requests by endpoint and note when the interesting
+things happen (a bet's legs placed, a betAccepted transaction received), so
+`benchmarks.e2e` can measure the whole pipeline from the outside.
+"""
+
+import base64
+import collections
+import hashlib
+import http.server
+import itertools
+import json
+import random
+import select
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+
+import rlp
+from web3 import Web3
+
+from decoder import BET_PLACED_TOPIC
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, and the reply in one write: no Nagle/delayed-ACK stalls.
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def reply(self, status: int, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server:
+    def __init__(self, handler, port: int = 0):
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _order(params: dict, order_id: int, status: str, price: str) -> dict:
+    quantity = params.get("quantity", "0")
+    filled = status == "FILLED"
+    return {
+        "clientOrderId": params.get("newClientOrderId", ""),
+        "cumQuote": "0",
+        "executedQty": quantity if filled else "0",
+        "orderId": order_id,
+        "origQty": quantity,
+        "price": "0",
+        "reduceOnly": False,
+        "side": params.get("side", ""),
+        "status": status,
+        "stopPrice": params.get("stopPrice", "0"),
+        "symbol": params.get("symbol", "BTCUSDT"),
+        "timeInForce": "GTC",
+        "type": params.get("type", ""),
+        "updateTime": int(time.time() * 1000),
+        "workingType": "CONTRACT_PRICE",
+        "avgPrice": price if filled else "0",
+        "origType": params.get("type", ""),
+        "positionSide": "BOTH",
+        "closePosition": False,
+    }
+
+
+def _symbol_info(symbol: str) -> dict:
+    return {
+        "symbol": symbol,
+        "filters": [
+            {"filterType": "PRICE_FILTER", "tickSize": "0.10", "minPrice": "556.80", "maxPrice": "4529764"},
+            {"filterType": "LOT_SIZE", "stepSize": "0.001", "minQty": "0.001", "maxQty": "1000"},
+            {"filterType": "MARKET_LOT_SIZE", "stepSize": "0.001", "minQty": "0.001", "maxQty": "120"},
+        ],
+    }
+
+
+class _ExchangeHandler(_Handler):
+    def handle_any(self):
+        fake = self.server.fake
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        with fake.lock:
+            fake.requests[f"{self.command} {url.path}"] += 1
+        if fake.latency:
+            time.sleep(fake.latency)
+        status, body = fake.handle(self.command, url.path, params)
+        self.reply(status, body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_any
+
+
+class FakeExchange(_Server):
+    """
+    The futures endpoints `binance_wrappers` uses. Market orders fill at the
+    mark price right away, SL/TP legs stay open until cancelled. With
+    `leg_fill_rate`, every open orders listing fills each open leg with that
+    probability, so the reconciliation path gets exercised as well.
+    """
+
+    def __init__(self, latency: float = 0.0, price: float = 40000.0, leg_fill_rate: float = 0.0, port: int = 0,
+                 symbols=("BTCUSDT",)):
+        super().__init__(_ExchangeHandler, port)
+        self.symbols = symbols
+        self.latency = latency
+        self.price = price
+        self.leg_fill_rate = leg_fill_rate
+        self.orders = {}  # client order id -> order
+        self.open = {}  # client order id -> order, the open SL/TP legs
+        self.legs_placed = {}  # bet id -> time its second leg arrived
+        self._ids = itertools.count(1)
+
+    def handle(self, method: str, path: str, params: dict):
+        with self.lock:
+            if path == "/fapi/v1/premiumIndex":
+                return 200, {"symbol": params.get("symbol", "BTCUSDT"), "markPrice": str(self.price),
+                             "lastFundingRate": "0", "nextFundingTime": 0, "time": int(time.time() * 1000)}
+            if path == "/fapi/v1/leverage":
+                return 200, {"leverage": int(params["leverage"]), "maxNotionalValue": "1000000",
+                             "symbol": params["symbol"]}
+            if path == "/fapi/v1/marginType":
+                return 400, {"code": -4046, "msg": "No need to change margin type."}
+            if path == "/fapi/v1/exchangeInfo":
+                return 200, {"symbols": [_symbol_info(symbol) for symbol in self.symbols]}
+            if path == "/fapi/v1/time":
+                return 200, {"serverTime": int(time.time() * 1000)}
+            if path == "/fapi/v1/order" and method == "POST":
+                return self.place(params)
+            if path == "/fapi/v1/order" and method == "GET":
+                order = self.orders.get(params["origClientOrderId"])
+                return (200, order) if order is not None else (400, {"code": -2013, "msg": "Order does not exist."})
+            if path == "/fapi/v1/order" and method == "DELETE":
+                return self.cancel(params["origClientOrderId"])
+            if path == "/fapi/v1/batchOrders" and method == "POST":
+                results = [self.place(order)[1] for order in json.loads(params["batchOrders"])]
+                return 200, results
+            if path == "/fapi/v1/batchOrders" and method == "DELETE":
+                return 200, [self.cancel(client_order_id)[1]
+                             for client_order_id in json.loads(params["origClientOrderIdList"])]
+            if path == "/fapi/v1/openOrders":
+                self.fill_legs()
+                return 200, list(self.open.values())
+        return 404, {"code": -1, "msg": f"{method} {path} is not faked"}
+
+    def place(self, params: dict):
+        client_order_id = params.get("newClientOrderId", "")
+        if client_order_id in self.orders:
+            return 400, {"code": -4015, "msg": "Client order id is not valid."}
+        if params["type"] == "MARKET":
+            order = _order(params, next(self._ids), "FILLED", str(self.price))
+            self.orders[client_order_id] = order
+            return 200, order
+        order = _order(params, next(self._ids), "NEW", "0")
+        self.orders[client_order_id] = order
+        self.open[client_order_id] = order
+        # Client order ids are the bet id and the role: 2 take profit, 3 stop loss.
+        base = client_order_id[:-1]
+        if base.isdigit() and f"{base}2" in self.orders and f"{base}3" in self.orders:
+            self.legs_placed.setdefault(int(base), time.monotonic())
+        return 200, order
+
+    def cancel(self, client_order_id: str):
+        order = self.open.pop(client_order_id, None)
+        if order is None:
+            return 400, {"code": -2011, "msg": "Unknown order sent."}
+        order["status"] = "CANCELED"
+        return 200, order
+
+    def fill_legs(self):
+        if not self.leg_fill_rate:
+            return
+        for client_order_id in list(self.open):
+            if random.random() < self.leg_fill_rate:
+                self.open.pop(client_order_id)["status"] = "FILLED"
+
+
+def _ws_frame(payload: bytes, opcode: int = 0x1) -> bytes:
+    """ An unmasked, unfragmented server frame; 0x1 text, 0x8 close. """
+    length = len(payload)
+    if length < 126:
+        header = bytes([0x80 | opcode, length])
+    elif length < 1 << 16:
+        header = bytes([0x80 | opcode, 126]) + length.to_bytes(2, "big")
+    else:
+        header = bytes([0x80 | opcode, 127]) + length.to_bytes(8, "big")
+    return header + payload
+
+
+def _read_ws_frame(sock) -> tuple:
+    """ (opcode, payload) of a masked client frame. """
+    def read(count: int) -> bytes:
+        data = b""
+        while len(data) < count:
+            chunk = sock.recv(count - len(data))
+            if not chunk:
+                raise ConnectionError("closed")
+            data += chunk
+        return data
+
+    first, second = read(2)
+    length = second & 0x7F
+    if length == 126:
+        length = int.from_bytes(read(2), "big")
+    elif length == 127:
+        length = int.from_bytes(read(8), "big")
+    mask = read(4)
+    payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(read(length)))
+    return first & 0x0F, payload
+
+
+class _StreamHandler(socketserver.BaseRequestHandler):
+    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+    def handle(self):
+        fake = self.server.fake
+        request = b""
+        while b"\r\n\r\n" not in request:
+            chunk = self.request.recv(4096)
+            if not chunk:
+                return
+            request += chunk
+        lines = request.decode().split("\r\n")
+        headers = dict(line.split(": ", 1) for line in lines[1:] if ": " in line)
+        key = {name.lower(): value for name, value in headers.items()}["sec-websocket-key"]
+        accept = base64.b64encode(hashlib.sha1((key + self.GUID).encode()).digest()).decode()
+        self.request.sendall(
+            "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n".encode()
+        )
+        with fake.lock:
+            fake.connections += 1
+            fake.paths.append(lines[0].split(" ")[1])
+            fake.sockets.add(self.request)
+        try:
+            while self.request in fake.sockets:
+                if fake.pushing:
+                    for symbol in fake.symbols:
+                        self.request.sendall(_ws_frame(json.dumps({
+                            "stream": f"{symbol.lower()}@markPrice@1s",
+                            "data": {"e": "markPriceUpdate", "E": int(time.time() * 1000), "s": symbol,
+                                     "p": str(fake.price)},
+                        }).encode()))
+                # Answers pings and a close while waiting for the next push.
+                if select.select([self.request], [], [], fake.interval)[0]:
+                    opcode, payload = _read_ws_frame(self.request)
+                    if opcode == 0x9:
+                        self.request.sendall(_ws_frame(payload, opcode=0xA))
+                    elif opcode == 0x8:
+                        self.request.sendall(_ws_frame(payload, opcode=0x8))
+                        return
+        except OSError:
+            pass
+        finally:
+            with fake.lock:
+                fake.sockets.discard(self.request)
+
+
+class FakeMarkPriceStream:
+    """
+    The `<symbol>@markPrice@1s` streams: every connection gets a
+    markPriceUpdate of `price` for each of `symbols` every `interval`
+    seconds, while `pushing` is set. `drop` closes the connections from
+    the server side, as Binance does every 24 hours.
+    """
+
+    def __init__(self, price: float = 40000.0, interval: float = 1.0, symbols=("BTCUSDT",), port: int = 0):
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", port), _StreamHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.price = price
+        self.interval = interval
+        self.symbols = symbols
+        self.pushing = True
+        self.connections = 0  # accepted so far
+        self.paths = []
+        self.sockets = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"ws://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.drop()
+        self.server.server_close()
+
+    def drop(self):
+        with self.lock:
+            sockets, self.sockets = self.sockets, set()
+        for sock in sockets:
+            try:
+                sock.sendall(_ws_frame((1000).to_bytes(2, "big"), opcode=0x8))
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class _RpcHandler(_Handler):
+    def do_POST(self):
+        fake = self.server.fake
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if fake.latency:
+            time.sleep(fake.latency)
+        batch = isinstance(request, list)
+        responses = [fake.call(item) for item in (request if batch else [request])]
+        self.reply(200, responses if batch else responses[0])
+
+
+class FakeChain(_Server):
+    """
+    A node with a growing chain: a new block every `block_time` seconds,
+    carrying the BetPlaced logs queued with `place_bets`. It serves logs,
+    filters, blocks, nonces and accepts raw transactions, noting the
+    betAccepted calls by bet id.
+    """
+
+    BET_ACCEPTED_SELECTOR = Web3.keccak(text="betAccepted(uint256,uint256,uint256,uint256)")[:4]
+
+    def __init__(self, contract: str, block_time: float = 0.25, latency: float = 0.0, port: int = 0):
+        super().__init__(_RpcHandler, port)
+        self.contract = contract.lower()
+        self.block_time = block_time
+        self.latency = latency
+        self.started = time.monotonic()
+        self.logs = collections.defaultdict(list)  # block -> logs
+        self.visible = {}  # bet id -> time its block was mined
+        self.accepted = {}  # bet id -> time its betAccepted arrived
+        self.filters = {}  # filter id -> last delivered block
+        self.nonce = 0
+        self._queued = []
+        self._ids = itertools.count(1)
+        self._head = 0
+
+    def head(self) -> int:
+        """ Mines the blocks due by now, with the queued bets in the first one. """
+        head = int((time.monotonic() - self.started) / self.block_time)
+        if head > self._head:
+            if self._queued:
+                block = self._head + 1
+                now = time.monotonic()
+                for bet_id, direction, amount in self._queued:
+                    self.logs[block].append(self._log(block, len(self.logs[block]), bet_id, direction, amount))
+                    self.visible[bet_id] = now
+                self._queued = []
+            self._head = head
+        return self._head
+
+    def place_bets(self, bets):
+        """ (bet id, direction, amount in wei) for the next block. """
+        with self.lock:
+            self._queued.extend(bets)
+
+    def _log(self, block: int, index: int, bet_id: int, direction: int, amount: int) -> dict:
+        return {
+            "address": Web3.toChecksumAddress(self.contract),
+            "topics": [
+                BET_PLACED_TOPIC,
+                "0x" + bet_id.to_bytes(32, "big").hex(),
+                "0x" + bytes(12).hex() + random.randbytes(20).hex(),
+            ],
+            "data": "0x" + direction.to_bytes(32, "big").hex() + amount.to_bytes(32, "big").hex(),
+            "blockNumber": hex(block),
+            "blockHash": self._hash(block),
+            "transactionHash": "0x" + random.randbytes(32).hex(),
+            "transactionIndex": hex(index),
+            "logIndex": hex(index),
+            "removed": False,
+        }
+
+    @staticmethod
+    def _hash(block: int) -> str:
+        return "0x" + block.to_bytes(32, "big").hex()
+
+    @staticmethod
+    def _block_number(value, default: int) -> int:
+        if value in (None, "latest", "pending"):
+            return default
+        if value == "earliest":
+            return 0
+        return int(value, 16) if isinstance(value, str) else int(value)
+
+    def _range(self, start: int, end: int):
+        return [log for block in range(start, end + 1) for log in self.logs.get(block, ())]
+
+    def call(self, request: dict) -> dict:
+        method, params = request["method"], request.get("params") or []
+        with self.lock:
+            self.requests[method] += 1
+            try:
+                result = self.dispatch(method, params)
+            except KeyError as e:
+                return {"jsonrpc": "2.0", "id": request["id"], "error": {"code": -32000, "message": f"unknown {e}"}}
+        return {"jsonrpc": "2.0", "id": request["id"], "result": result}
+
+    def dispatch(self, method: str, params):
+        head = self.head()
+        if method == "web3_clientVersion":
+            return "fake/v1"
+        if method == "net_version":
+            return "97"
+        if method == "eth_chainId":
+            return hex(97)
+        if method == "eth_blockNumber":
+            return hex(head)
+        if method == "eth_getBlockByNumber":
+            number = self._block_number(params[0], head)
+            return {"number": hex(number), "hash": self._hash(number), "parentHash": self._hash(number - 1),
+                    "timestamp": hex(int(number * self.block_time)), "transactions": []}
+        if method == "eth_getLogs":
+            return self._range(self._block_number(params[0].get("fromBlock"), head),
+                               self._block_number(params[0].get("toBlock"), head))
+        if method == "eth_newFilter":
+            filter_id = hex(next(self._ids))
+            self.filters[filter_id] = self._block_number(params[0].get("fromBlock"), head) - 1
+            return filter_id
+        if method in ("eth_getFilterLogs", "eth_getFilterChanges"):
+            start = self.filters[params[0]] + 1
+            self.filters[params[0]] = head
+            return self._range(start, head)
+        if method == "eth_uninstallFilter":
+            return self.filters.pop(params[0], None) is not None
+        if method == "eth_getTransactionCount":
+            return hex(self.nonce)
+        if method == "eth_sendRawTransaction":
+            self.nonce += 1
+            raw = bytes.fromhex(params[0][2:])
+            data = rlp.decode(raw)[5]
+            if data[:4] == self.BET_ACCEPTED_SELECTOR:
+                self.accepted.setdefault(int.from_bytes(data[4:36], "big"), time.monotonic())
+            return "0x" + Web3.keccak(raw).hex()[2:]
+        if method == "eth_getTransactionReceipt":
+            return {"transactionHash": params[0], "transactionIndex": "0x0", "blockHash": self._hash(head),
+                    "blockNumber": hex(head), "from": "0x" + "00" * 20, "to": self.contract,
+                    "cumulativeGasUsed": "0x5208", "gasUsed": "0x5208", "contractAddress": None,
+                    "logs": [], "logsBloom": "0x" + "00" * 256, "status": "0x1"}
+        raise KeyError(method)
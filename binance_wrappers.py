@@ -2,21 +2,31 @@
 This module is just a wrapper over python-binance module.
 """
 
-from collections import defaultdict
 import decimal
 import enum
 import decimal
 from typing import Tuple, List
 import logging
-import pprint
 import math
+import threading
+import time
+import urllib.parse
 
+import requests
+from requests.adapters import HTTPAdapter
 from binance_f import RequestClient
+from binance_f.impl import restapiinvoker
+from binance_f.impl.utils.apisignature import create_signature
+from binance_f.impl.utils.timeservice import get_current_timestamp
+from binance_f.impl.utils.urlparamsbuilder import UrlParamsBuilder
 from binance_f.model.order import Order
 from binance_f.model.constant import OrderSide, OrderType, OrderRespType, FuturesMarginType
 from binance_f.exception.binanceapiexception import BinanceApiException
 
+import metrics
 from models import BetDirection
+from rate_limit import POLLING, SETTLEMENT, RateLimiter
+from streams import MarkPriceCache, UserDataStream
 
 
 logger = logging.getLogger(__name__)
@@ -46,44 +56,508 @@ def parse_client_order_id(order_id: str) -> Tuple[str, OrderRole]:
     return (base, order_role)
 
 
-def client(fn):
-    def _client(config, *args, **kwargs):
-        client = RequestClient(
+DEFAULT_SYMBOL = "BTCUSDT"
+
+
+class PooledRequestClient(RequestClient):
+    """
+    RequestClient bound to its config block and to the registry session.
+    The block's `symbol` is the market this client trades.
+
+    `signed_request` covers the endpoints binance_f doesn't wrap, such as
+    placing a batch of orders.
+    """
+
+    def __init__(self, config, session):
+        super().__init__(
             api_key=config["API_Key"],
             secret_key=config["Secret_Key"],
             url=config["URL"],
         )
-        return fn(client, *args, **kwargs)
+        self.config = config
+        self.symbol = config.get("symbol", DEFAULT_SYMBOL)
+        self.session = session
+
+    def public_request(self, path: str):
+        return self.session.get(f"{self.config['URL']}{path}").json()
+
+    def signed_request(self, method: str, path: str, params: dict):
+        builder = UrlParamsBuilder()
+        for name, value in params.items():
+            builder.put_url(name, value)
+        builder.put_url("recvWindow", 60000)
+        builder.put_url("timestamp", str(get_current_timestamp() - 1000))
+        create_signature(self.config["Secret_Key"], builder)
+        response = self.session.request(
+            method,
+            f"{self.config['URL']}{path}?{builder.build_url()}",
+            headers={"X-MBX-APIKEY": self.config["API_Key"]},
+        )
+        result = response.json()
+        if isinstance(result, dict) and result.get("code", 200) != 200:
+            raise BinanceApiException(
+                BinanceApiException.EXEC_ERROR, f"[Executing] {result['code']}: {result.get('msg', '')}"
+            )
+        return result
+
+
+class MeteredSession(requests.Session):
+    """
+    Counts the exchange requests and their errors, and times them, by
+    endpoint. Every request is charged to `limiter`, the rate budget of the
+    process's market shard; orders and cancels go ahead of the reads.
+    """
+
+    def __init__(self, limiter: RateLimiter = None):
+        super().__init__()
+        self.limiter = limiter
+
+    def request(self, method, url, *args, **kwargs):
+        method = method.upper()
+        if self.limiter is not None:
+            self.limiter.acquire(POLLING if method == "GET" else SETTLEMENT)
+        endpoint = f"{method} {urllib.parse.urlsplit(url).path}"
+        metrics.counter("exchange_requests_total", "Binance REST requests sent", endpoint=endpoint).inc()
+        started = time.monotonic()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except Exception:
+            metrics.counter("exchange_errors_total", "Failed or rejected Binance REST requests",
+                            endpoint=endpoint).inc()
+            raise
+        metrics.histogram("exchange_request_seconds", "Binance REST request latency",
+                          endpoint=endpoint).observe(time.monotonic() - started)
+        if response.status_code >= 400:
+            metrics.counter("exchange_errors_total", "Failed or rejected Binance REST requests",
+                            endpoint=endpoint).inc()
+        return response
+
+
+class ClientRegistry:
+    """
+    Long-lived RequestClients keyed by the `binance` config block.
+
+    binance_f sends every call through the module level `requests.get/post/...`
+    helpers, which means a new HTTPS connection (and TLS handshake) per call.
+    The registry installs one keep-alive `requests.Session` in their place,
+    so all the clients reuse warm connections until `shutdown` is called.
+    """
+
+    def __init__(self, pool_size: int = 10):
+        self.pool_size = pool_size
+        self.session = None
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, config) -> PooledRequestClient:
+        key = (config["URL"], config["API_Key"], config["Secret_Key"], config.get("symbol", DEFAULT_SYMBOL))
+        with self._lock:
+            if self.session is None:
+                self.session = self._open_session(config.get("rate_limits", []))
+            client = self._clients.get(key)
+            if client is None:
+                logger.info("Creating pooled binance client for %s on %s", key[3], config["URL"])
+                client = PooledRequestClient(config, self.session)
+                self._clients[key] = client
+            return client
+
+    def _open_session(self, rate_limits):
+        session = MeteredSession(RateLimiter(rate_limits, name="exchange") if rate_limits else None)
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        # Session has the same get/post/delete/put interface as the module.
+        restapiinvoker.requests = session
+        return session
+
+    def shutdown(self):
+        with self._lock:
+            self._clients.clear()
+            if self.session is not None:
+                restapiinvoker.requests = requests
+                self.session.close()
+                self.session = None
+
+
+_registry = ClientRegistry()
+
+
+def shutdown_clients():
+    global _mark_prices, _user_stream
+    if _mark_prices is not None:
+        _mark_prices.stop()
+        _mark_prices = None
+    if _user_stream is not None:
+        _user_stream.stop()
+        _user_stream = None
+    _registry.shutdown()
+    _account.reset()
+    _rules.reset()
+
+
+def client(fn):
+    def _client(config, *args, **kwargs):
+        return fn(_registry.get(config), *args, **kwargs)
 
     return _client
 
 
+def error_code(e: BinanceApiException):
+    """ '[Executing] -4046: No need to change margin type.' -> -4046 """
+    try:
+        return int(e.error_message.split(" ", 2)[1].rstrip(":"))
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+DEFAULT_LEVERAGE = 46
+
+
+class AccountSetup:
+    """
+    Leverage and margin type last applied per client and symbol.
+
+    Both settings are sticky on the exchange side, so they are applied once
+    (at startup, or when the desired values change) instead of costing two
+    extra round trips on every bet.
+    """
+
+    # Order rejections hinting that the exchange no longer has our leverage.
+    INVALIDATING_ERRORS = (
+        -2027,  # Exceeded the maximum allowable position at current leverage.
+        -2028,  # Leverage is smaller than permitted: insufficient margin balance.
+        -4028,  # Leverage is not valid.
+    )
+
+    def __init__(self):
+        self._desired = {}
+        self._applied = {}
+        self._lock = threading.Lock()
+
+    def configure(self, symbol: str, leverage: int, margin_type=FuturesMarginType.ISOLATED):
+        self._desired[symbol] = (leverage, margin_type)
+
+    def ensure(self, client, symbol: str) -> int:
+        desired = self._desired.get(symbol, (DEFAULT_LEVERAGE, FuturesMarginType.ISOLATED))
+        key = (id(client), symbol)
+        if self._applied.get(key) != desired:
+            with self._lock:
+                if self._applied.get(key) != desired:
+                    self._apply(client, symbol, *desired)
+                    self._applied[key] = desired
+        return desired[0]
+
+    def invalidate(self, client, symbol: str):
+        logger.info("Forgetting account setup of %s", symbol)
+        self._applied.pop((id(client), symbol), None)
+
+    def reset(self):
+        self._applied.clear()
+
+    @staticmethod
+    def _apply(client, symbol, leverage, margin_type):
+        logger.info("Setting %s leverage=%s, margin type=%s", symbol, leverage, margin_type)
+        client.change_initial_leverage(symbol, leverage)
+        try:
+            client.change_margin_type(symbol, margin_type)
+        except BinanceApiException as e:
+            if error_code(e) != -4046:  # No need to change margin type
+                logger.error("Unable to change margin type: %r", e.error_message)
+                raise
+
+
+_account = AccountSetup()
+
+
+class SymbolRules:
+    """ Quantity and price steps of a symbol, from its exchangeInfo filters. """
+
+    __slots__ = ("symbol", "tick_size", "step_size", "max_market_quantity")
+
+    def __init__(self, symbol: str, tick_size: decimal.Decimal, step_size: decimal.Decimal,
+                 max_market_quantity: decimal.Decimal):
+        self.symbol = symbol
+        self.tick_size = tick_size
+        self.step_size = step_size
+        self.max_market_quantity = max_market_quantity
+
+    @classmethod
+    def parse(cls, info: dict) -> "SymbolRules":
+        filters = {f["filterType"]: f for f in info["filters"]}
+        market_lot = filters.get("MARKET_LOT_SIZE", filters["LOT_SIZE"])
+        return cls(
+            info["symbol"],
+            decimal.Decimal(filters["PRICE_FILTER"]["tickSize"]),
+            decimal.Decimal(filters["LOT_SIZE"]["stepSize"]),
+            decimal.Decimal(market_lot["maxQty"]),
+        )
+
+    @staticmethod
+    def _round(value: decimal.Decimal, step: decimal.Decimal, rounding) -> decimal.Decimal:
+        steps = (value / step).to_integral_value(rounding=rounding)
+        return (steps * step).quantize(step.normalize() if step < 1 else decimal.Decimal(1))
+
+    def quantity(self, value: decimal.Decimal, rounding=decimal.ROUND_DOWN) -> decimal.Decimal:
+        return self._round(value, self.step_size, rounding)
+
+    def price(self, value: decimal.Decimal, rounding) -> decimal.Decimal:
+        return self._round(value, self.tick_size, rounding)
+
+    def __repr__(self):
+        return f"SymbolRules({self.symbol}, tick={self.tick_size}, step={self.step_size})"
+
+
+class SymbolRulesCache:
+    """ Rules by symbol, loaded once from GET /fapi/v1/exchangeInfo. """
+
+    def __init__(self):
+        self._rules = {}
+        self._lock = threading.Lock()
+
+    def get(self, client, symbol: str) -> SymbolRules:
+        rules = self._rules.get(symbol)
+        if rules is None:
+            with self._lock:
+                if symbol not in self._rules:
+                    self._load(client)
+                rules = self._rules.get(symbol)
+            if rules is None:
+                raise RuntimeError(f"Symbol {symbol} is not listed by the exchange")
+        return rules
+
+    def _load(self, client):
+        for info in client.public_request("/fapi/v1/exchangeInfo")["symbols"]:
+            try:
+                self._rules[info["symbol"]] = SymbolRules.parse(info)
+            except KeyError:
+                continue  # Not a tradable contract.
+
+    def reset(self):
+        self._rules.clear()
+
+
+_rules = SymbolRulesCache()
+
+
+class OrderRegistry:
+    """
+    Our SL/TP legs by base bet id: open (True) or gone (False).
+
+    Kept up to date from our own placements and cancels and from the user
+    data stream, so the bets left with exactly one open leg are known
+    without listing the open orders. `single_legged` only looks at the bets
+    changed since its last call. `resync` rebuilds everything from an open
+    orders snapshot.
+    """
+
+    LEGS = (OrderRole.STOP_LOSS, OrderRole.TAKE_PROFIT)
+    OPEN_STATUSES = ("NEW", "PARTIALLY_FILLED")
+    CLOSED_STATUSES = ("FILLED", "CANCELED", "EXPIRED")
+
+    def __init__(self):
+        self.legs = {}
+        self._changed = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def parse_leg(cls, client_order_id: str):
+        """ (base, role) of an SL/TP leg of ours, None for anything else. """
+        try:
+            base, role = parse_client_order_id(client_order_id)
+            base = int(base)
+        except ValueError:
+            return None
+        return (base, role) if role in cls.LEGS else None
+
+    def placed(self, client_order_id: str):
+        self._set(client_order_id, True)
+
+    def closed(self, client_order_id: str):
+        self._set(client_order_id, False)
+
+    def _set(self, client_order_id: str, is_open: bool):
+        leg = self.parse_leg(client_order_id)
+        if leg is None:
+            return
+        base, role = leg
+        with self._lock:
+            self.legs.setdefault(base, {})[role] = is_open
+            self._changed.add(base)
+
+    def on_order_update(self, order: dict):
+        status = order.get("X")
+        if status in self.OPEN_STATUSES:
+            self.placed(order["c"])
+        elif status in self.CLOSED_STATUSES:
+            self.closed(order["c"])
+
+    def resync(self, client_order_ids):
+        """ Replaces the state with a snapshot; a leg missing from it is gone. """
+        legs = {}
+        for client_order_id in client_order_ids:
+            leg = self.parse_leg(client_order_id)
+            if leg is not None:
+                legs.setdefault(leg[0], dict.fromkeys(self.LEGS, False))[leg[1]] = True
+        with self._lock:
+            self.legs = legs
+            self._changed = set(legs)
+
+    def open_bets(self) -> List[int]:
+        with self._lock:
+            return [base for base, legs in self.legs.items() if len(legs) == 2 and all(legs.values())]
+
+    def single_legged(self) -> List[Tuple[int, OrderRole]]:
+        """ Bets changed since the last call that have exactly one open leg left. """
+        result = []
+        with self._lock:
+            changed, self._changed = self._changed, set()
+            for base in changed:
+                legs = self.legs.get(base)
+                if legs is None:
+                    continue
+                open_roles = [role for role, is_open in legs.items() if is_open]
+                if not open_roles:
+                    del self.legs[base]
+                elif len(open_roles) == 1 and len(legs) == 2:
+                    result.append((base, open_roles[0]))
+        return result
+
+
+_orders = {}
+
+
+def order_registry(symbol: str) -> OrderRegistry:
+    """ The legs of one market's shard. """
+    registry = _orders.get(symbol)
+    if registry is None:
+        registry = _orders.setdefault(symbol, OrderRegistry())
+    return registry
+
+
+def single_legged_bets(config):
+    return order_registry(config.get("symbol", DEFAULT_SYMBOL)).single_legged()
+
+
+_mark_prices = None
+
+
+def start_mark_price_stream(config):
+    """ Starts the streaming mark price cache of the config's symbol if `stream_url` is configured. """
+    global _mark_prices
+    if not config.get("stream_url"):
+        return None
+    _mark_prices = MarkPriceCache(
+        config["stream_url"],
+        (config.get("symbol", DEFAULT_SYMBOL),),
+        fallback=lambda symbol: _registry.get(config).get_mark_price(symbol=symbol).markPrice,
+        max_age=config.get("max_price_age", 3.0),
+    )
+    _mark_prices.start()
+    return _mark_prices
+
+
+_user_stream = None
+
+
+def start_user_data_stream(config, on_order_update):
+    """ Starts pushing order updates if `user_stream` is enabled. """
+    global _user_stream
+    if not (config.get("stream_url") and config.get("user_stream")):
+        return None
+    client = _registry.get(config)
+    registry = order_registry(client.symbol)
+
+    def on_update(order):
+        # The stream is per account: other shards' markets are theirs to handle.
+        if order.get("s") != client.symbol:
+            return
+        registry.on_order_update(order)
+        on_order_update(order)
+
+    _user_stream = UserDataStream(
+        config["stream_url"],
+        start_listen_key=client.start_user_data_stream,
+        keep_listen_key=client.keep_user_data_stream,
+        on_order_update=on_update,
+    )
+    _user_stream.start()
+    return _user_stream
+
+
+def mark_price(client, symbol: str) -> decimal.Decimal:
+    if _mark_prices is not None:
+        return _mark_prices.get(symbol)
+    return decimal.Decimal(str(client.get_mark_price(symbol=symbol).markPrice))
+
+
 @client
-def create_order(client, base_order_id: str, direction: BetDirection, position_usd_amount: decimal.Decimal, boundary_calculator):
+def setup_account(client, leverage: int = DEFAULT_LEVERAGE):
+    logger.info("Trading %r", _rules.get(client, client.symbol))
+    _account.configure(client.symbol, leverage)
+    _account.ensure(client, client.symbol)
+
+
+def position_quantity(position_usd_amount: decimal.Decimal, leverage: int,
+                      price: decimal.Decimal, rules: SymbolRules) -> decimal.Decimal:
     # TESTING
     position_usd_amount *= 1000
 
-    leverage = 46
-    position_usd_amount *= leverage
+    exact_value = position_usd_amount * leverage / price
+    return rules.quantity(exact_value)
 
-    client.change_initial_leverage("BTCUSDT", leverage)
-    try:
-        client.change_margin_type("BTCUSDT", FuturesMarginType.ISOLATED)
-    except BinanceApiException as e:
-        ok_errors = ['[Executing] -4046: No need to change margin type.'] # No need to change margin type
-        logger.error("Raising the exception because error message %r is not in %r", e.error_message, ok_errors)
-        if (e.error_message not in ok_errors):
-            raise
-    btc_price = client.get_mark_price(symbol="BTCUSDT").markPrice
-    exact_value = position_usd_amount / decimal.Decimal(btc_price)
-    # quantity = math.floor(exact_value / precision) * precision
-    quantity = str(exact_value.quantize(decimal.Decimal('.001'), rounding=decimal.ROUND_DOWN))
-    
-    logger.info("BTC_price=%s, position_usd_amount=%s, quantity=%s",
-                btc_price, position_usd_amount, quantity)
+
+@client
+def create_order(client, base_order_id: str, direction: BetDirection, position_usd_amount: decimal.Decimal,
+                 boundary_calculator, record=None, filled: dict = None, placed=(), timer=None):
+    """
+    Opens the position of a bet and places its SL/TP legs.
+
+    `record(role, data)` is told about every completed step: the market fill
+    (INITIAL_MKT, with `filled_order_data`) and each placed leg. A bet
+    resumed from the journal passes its recorded fill as `filled` and the
+    legs already `placed`, then only the missing steps are run. `timer`, a
+    `metrics.BetTimer`, gets the stages before the fill.
+    """
+    if filled is not None:
+        result = filled_order(filled)
+        logger.info("Resuming %s after its market fill at %s", base_order_id, result.avgPrice)
+    else:
+        result = post_initial_order(client, base_order_id, direction, position_usd_amount, timer)
+        if result is None:
+            return
+        if record is not None:
+            record(OrderRole.INITIAL_MKT, filled_order_data(result))
+
+    rules = _rules.get(client, client.symbol)
+    stop_loss_price, take_profit_price = boundary_calculator(decimal.Decimal(result.avgPrice), direction)
+    if direction == BetDirection.UP:
+        stop_loss_price = rules.price(stop_loss_price, decimal.ROUND_UP)
+        take_profit_price = rules.price(take_profit_price, decimal.ROUND_DOWN)
+    else:
+        stop_loss_price = rules.price(stop_loss_price, decimal.ROUND_DOWN)
+        take_profit_price = rules.price(take_profit_price, decimal.ROUND_UP)
+    logger.info("Stop loss %s , take profit %s", stop_loss_price, take_profit_price)
+
+    create_stoppers(client, result, direction, take_profit_price, stop_loss_price, record=record, placed=placed)
+
+
+def post_initial_order(client, base_order_id: str, direction: BetDirection,
+                       position_usd_amount: decimal.Decimal, timer=None) -> Order:
+    """ The bet's market order, None if it was placed already. """
+    symbol = client.symbol
+    leverage = _account.ensure(client, symbol)
+    if timer is not None:
+        timer.mark("leverage_set")
+    price = mark_price(client, symbol)
+    if timer is not None:
+        timer.mark("mark_price")
+    quantity = str(position_quantity(position_usd_amount, leverage, price, _rules.get(client, symbol)))
+
+    logger.info("%s price=%s, position_usd_amount=%s, quantity=%s",
+                symbol, price, position_usd_amount, quantity)
     try:
         result = client.post_order(
-            symbol="BTCUSDT",
+            symbol=symbol,
             side=OrderSide.BUY if direction == BetDirection.UP else OrderSide.SELL,
             ordertype=OrderType.MARKET,
             quantity=quantity,
@@ -92,116 +566,329 @@ def create_order(client, base_order_id: str, direction: BetDirection, position_u
             newOrderRespType=OrderRespType.RESULT
         )
     except BinanceApiException as e:
+        if error_code(e) in AccountSetup.INVALIDATING_ERRORS:
+            _account.invalidate(client, symbol)
         ok_errors = ['[Executing] -4015: Client order id is not valid.']
         logger.error("Raising the exception because error message %r is not in %r", e.error_message, ok_errors)
         if (e.error_message not in ok_errors):
             raise
         else:
             logger.info("Worked with overlap, tried to create an order with the same ID: %s, got rejected, its OK", get_client_order_id(base_order_id, OrderRole.INITIAL_MKT))
-            return
-    logger.info("Created and executed order for the position: %r", result)
+            return None
+    logger.info("Market order %s filled %s at %s", result.clientOrderId, result.executedQty, result.avgPrice)
     assert result.status == "FILLED"
+    return result
 
-    stop_loss_price, take_profit_price = boundary_calculator(decimal.Decimal(result.avgPrice), direction)
-    if direction == BetDirection.UP:
-        stop_loss_price = stop_loss_price.quantize(decimal.Decimal('.01'), rounding=decimal.ROUND_UP)
-        take_profit_price = take_profit_price.quantize(decimal.Decimal('.01'), rounding=decimal.ROUND_DOWN)
-    else:
-        stop_loss_price = stop_loss_price.quantize(decimal.Decimal('.01'), rounding=decimal.ROUND_DOWN)
-        take_profit_price = take_profit_price.quantize(decimal.Decimal('.01'), rounding=decimal.ROUND_UP)
-    logger.info("Stop loss %s , take profit %s", stop_loss_price, take_profit_price)
 
-    create_stoppers(client, result, direction, take_profit_price, stop_loss_price)
+def filled_order_data(order: Order) -> dict:
+    """ What `create_stoppers` needs of a filled order, for the journal. """
+    return {
+        "symbol": order.symbol,
+        "clientOrderId": order.clientOrderId,
+        "avgPrice": str(order.avgPrice),
+        "executedQty": str(order.executedQty),
+    }
+
+
+def filled_order(data: dict) -> Order:
+    order = Order()
+    order.symbol = data["symbol"]
+    order.clientOrderId = data["clientOrderId"]
+    order.avgPrice = data["avgPrice"]
+    order.executedQty = data["executedQty"]
+    order.status = "FILLED"
+    return order
 
 
 def create_stoppers(client, base_order: Order, direction: BetDirection,
-                    take_profit_price: float = None, stop_loss_price: float = None):
+                    take_profit_price: float = None, stop_loss_price: float = None, record=None, placed=()):
     side = OrderSide.SELL if (direction == BetDirection.UP) else OrderSide.BUY
     base = parse_client_order_id(base_order.clientOrderId)[0]
-    executed_qty = decimal.Decimal(base_order.executedQty).quantize(decimal.Decimal("0.001"))
-    try:
-        stop_loss_order = client.post_order(
-            symbol=base_order.symbol,
-            side=side,
-            ordertype=OrderType.STOP_MARKET,
-            quantity=executed_qty,
-            stopPrice=str(stop_loss_price),
-            positionSide="BOTH",
-            newClientOrderId=get_client_order_id(base, OrderRole.STOP_LOSS),
+    # binance_f parses it as a float, 1.15 would round down to 1.149.
+    executed_qty = _rules.get(client, base_order.symbol).quantity(decimal.Decimal(str(base_order.executedQty)))
+    if record is None:
+        record = lambda role, data: None
+    if client.config.get("batch_stoppers"):
+        return create_stoppers_batch(client, base_order.symbol, base, side, executed_qty,
+                                     take_profit_price, stop_loss_price, record, placed)
+    if OrderRole.STOP_LOSS not in placed:
+        try:
+            stop_loss_order = client.post_order(
+                symbol=base_order.symbol,
+                side=side,
+                ordertype=OrderType.STOP_MARKET,
+                quantity=executed_qty,
+                stopPrice=str(stop_loss_price),
+                positionSide="BOTH",
+                newClientOrderId=get_client_order_id(base, OrderRole.STOP_LOSS),
+            )
+            logger.info("Created (ack) stop loss order: %r", stop_loss_order)
+            order_registry(base_order.symbol).placed(get_client_order_id(base, OrderRole.STOP_LOSS))
+            record(OrderRole.STOP_LOSS, None)
+        except BinanceApiException as e:
+            if e.error_message == '[Executing] -4015: Client order id is not valid.':
+                # TODO: deduce position
+                record(OrderRole.STOP_LOSS, None)
+
+    if OrderRole.TAKE_PROFIT not in placed:
+        try:
+            take_profit_order = client.post_order(
+                symbol=base_order.symbol,
+                side=side,
+                ordertype=OrderType.TAKE_PROFIT_MARKET,
+                quantity=executed_qty,
+                stopPrice=str(take_profit_price),
+                positionSide="BOTH",
+                newClientOrderId=get_client_order_id(base, OrderRole.TAKE_PROFIT),
+            )
+            logger.info("Created (ack) take profit order: %r", take_profit_order)
+            order_registry(base_order.symbol).placed(get_client_order_id(base, OrderRole.TAKE_PROFIT))
+            record(OrderRole.TAKE_PROFIT, None)
+        except BinanceApiException as e:
+            if e.error_message == '[Executing] -4015: Client order id is not valid.':
+                # TODO: deduce position, remove stop order
+                record(OrderRole.TAKE_PROFIT, None)
+
+
+def create_stoppers_batch(client, symbol: str, base: str, side, quantity: decimal.Decimal,
+                          take_profit_price, stop_loss_price, record, placed_roles=()):
+    """
+    Places both legs with a single POST /fapi/v1/batchOrders, so there is one
+    round trip and no moment when only one of them exists. Results come back
+    in the submitted order. If one leg is rejected, the surviving leg is
+    cancelled and the error is raised. Legs in `placed_roles` are skipped.
+    """
+    legs = [
+        (role, order_type, price) for role, order_type, price in (
+            (OrderRole.STOP_LOSS, OrderType.STOP_MARKET, stop_loss_price),
+            (OrderRole.TAKE_PROFIT, OrderType.TAKE_PROFIT_MARKET, take_profit_price),
+        ) if role not in placed_roles
+    ]
+    if not legs:
+        return
+    orders = [
+        {
+            "symbol": symbol,
+            "side": side,
+            "type": order_type,
+            "quantity": str(quantity),
+            "stopPrice": str(price),
+            "positionSide": "BOTH",
+            "newClientOrderId": get_client_order_id(base, role),
+        }
+        for role, order_type, price in legs
+    ]
+    results = client.signed_request("POST", "/fapi/v1/batchOrders", {"batchOrders": orders})
+
+    registry = order_registry(symbol)
+    placed, failed = [], []
+    for order, result in zip(orders, results):
+        role = parse_client_order_id(order["newClientOrderId"])[1]
+        if "code" not in result:
+            logger.info("Created (ack) %s order: %r", role.name, result)
+            placed.append(result["clientOrderId"])
+            registry.placed(result["clientOrderId"])
+        elif result["code"] == -4015:
+            # Client order id is taken: the leg was placed by an earlier run.
+            logger.info("%s order %s already exists", role.name, order["newClientOrderId"])
+            registry.placed(order["newClientOrderId"])
+        else:
+            failed.append((role, result))
+
+    if failed:
+        for client_order_id in placed:
+            logger.warning("Rolling back %s, the other leg was rejected", client_order_id)
+            client.cancel_order(symbol=symbol, origClientOrderId=client_order_id)
+            registry.closed(client_order_id)
+        role, result = failed[0]
+        raise BinanceApiException(
+            BinanceApiException.EXEC_ERROR,
+            f"[Executing] {result['code']}: {role.name} leg of {base}: {result.get('msg', '')}",
         )
-        logger.info("Created (ack) stop loss order: %r", stop_loss_order)
-    except BinanceApiException as e:
-        if e.error_message == '[Executing] -4015: Client order id is not valid.':
-            # TODO: deduce position
-            pass
+    for order in orders:
+        record(parse_client_order_id(order["newClientOrderId"])[1], None)
 
+
+def post_market_order(client, client_order_id: str, signed_quantity: decimal.Decimal) -> Order:
+    """ Buys a positive `signed_quantity`, sells a negative one. None if already placed. """
     try:
-        take_profit_order = client.post_order(
-            symbol=base_order.symbol,
-            side=side,
-            ordertype=OrderType.TAKE_PROFIT_MARKET,
-            quantity=executed_qty,
-            stopPrice=str(take_profit_price),
+        result = client.post_order(
+            symbol=client.symbol,
+            side=OrderSide.BUY if signed_quantity > 0 else OrderSide.SELL,
+            ordertype=OrderType.MARKET,
+            quantity=str(abs(signed_quantity)),
             positionSide="BOTH",
-            newClientOrderId=get_client_order_id(base, OrderRole.TAKE_PROFIT),
+            newClientOrderId=client_order_id,
+            newOrderRespType=OrderRespType.RESULT
         )
-        logger.info("Created (ack) take profit order: %r", take_profit_order)
     except BinanceApiException as e:
-        if e.error_message == '[Executing] -4015: Client order id is not valid.':
-            # TODO: deduce position, remove stop order
-            pass
+        if error_code(e) in AccountSetup.INVALIDATING_ERRORS:
+            _account.invalidate(client, client.symbol)
+        if error_code(e) != -4015:  # Client order id is not valid.
+            raise
+        logger.info("Order %s was already placed", client_order_id)
+        return None
+    logger.info("Market order %s filled %s at %s", result.clientOrderId, result.executedQty, result.avgPrice)
+    assert result.status == "FILLED"
+    return result
+
+
+@client
+def create_market_order(client, client_order_id: str, signed_quantity: decimal.Decimal):
+    return post_market_order(client, client_order_id, signed_quantity)
+
+
+@client
+def create_net_order(client, client_order_id: str, legs) -> Tuple[decimal.Decimal, List[decimal.Decimal]]:
+    """
+    Sizes every (direction, usd amount) leg at the current mark price, but
+    opens only their net with a single market order. Returns the entry price
+    and the per-leg quantities.
+    """
+    leverage = _account.ensure(client, client.symbol)
+    price = mark_price(client, client.symbol)
+    rules = _rules.get(client, client.symbol)
+    quantities = [position_quantity(amount, leverage, price, rules) for _, amount in legs]
+    net = sum(
+        (quantity if direction == BetDirection.UP else -quantity
+         for (direction, _), quantity in zip(legs, quantities)),
+        decimal.Decimal(0),
+    )
+    logger.info("Netting %d legs at %s into %s", len(legs), price, net)
+    if net == 0:
+        return price, quantities
+    result = post_market_order(client, client_order_id, net)
+    if result is None:
+        return price, quantities
+    return decimal.Decimal(result.avgPrice), quantities
+
+
+@client
+def get_mark_price(client) -> decimal.Decimal:
+    return mark_price(client, client.symbol)
 
 
 @client
 def get_orders(client):
     # result = client.get_order(origClientOrderId="20210222064502")
-    result = client.get_open_orders("BTCUSDT")
-    pprint.pprint(result)
+    result = client.get_open_orders(client.symbol)
+    logger.info("Open orders: %r", result)
+    return result
 
 
 @client
 def cancel_order(client, client_order_id):
-    # result = client.get_order(origClientOrderId="20210222064502")
-    # result = client.get_open_orders("BTCUSDT")
-    result = client.cancel_order(symbol="BTCUSDT", origClientOrderId=client_order_id)
-    pprint.pprint(result)
+    result = client.cancel_order(symbol=client.symbol, origClientOrderId=client_order_id)
+    logger.debug("Cancelled %s: %r", client_order_id, result)
+    order_registry(client.symbol).closed(client_order_id)
+    return result
+
+
+# DELETE /fapi/v1/batchOrders takes up to 10 client order ids.
+CANCEL_BATCH_SIZE = 10
+
+
+def cancel_orders_batch(client, client_order_ids: List[str], symbol: str) -> dict:
+    """
+    Cancels the orders in one request per CANCEL_BATCH_SIZE ids. Returns
+    client order id -> the cancelled order, or the error result. Unknown
+    orders (already filled or cancelled) come back as error -2011.
+    """
+    results = {}
+    for start in range(0, len(client_order_ids), CANCEL_BATCH_SIZE):
+        chunk = client_order_ids[start:start + CANCEL_BATCH_SIZE]
+        response = client.signed_request(
+            "DELETE", "/fapi/v1/batchOrders", {"symbol": symbol, "origClientOrderIdList": chunk})
+        results.update(zip(chunk, response))
+    return results
 
 
 @client
-def check_open_orders(client) -> Tuple[List[str], List[Tuple[str, OrderRole]]]:
-    """
-    Gets a list of open orders from Binance and classifies them as
-      - orders still open (we need to check if they have timed out).
-      - orders to close - orders where one of the legs was triggered,
-        so we need to close the open leg, and check for the reward
-        logic.
-
-    Because our ClientOrderIDs have a format base+0 base+1 base+2,
-    we can get all open orders and check if both of them (base+1, base+2)
-    are open. If yes, then base order is still open. Otherwise, we need to close
-    other orders and decide about payouts.
-    """
-    orders = client.get_open_orders("BTCUSDT")
-    buckets = defaultdict(list)
-    logger.info("Currently open orders: %r", orders)
-    for order in orders:
-        base, role = parse_client_order_id(order.clientOrderId)
-        buckets[base].append(role)
-
-    open_orders = []
-    orders_to_close = []
-
-    for base, open_roles in buckets.items():
-        base = int(base)
-        if len(open_roles) > 1:
-            # NB! This method should be called on a same thread as
-            # order creator, because stop order / take profit creation
-            # is not transactional, so, if runs in parallel, it is possible
-            # that this method will see only created stop-loss order, and
-            # it'll make a decision that take profit is already closed.
-            # But it was not created yet actually.
-            open_orders.append(base)
-        elif len(open_roles) == 1:
-            orders_to_close.append((base, open_roles[0]))
-
-    return open_orders, orders_to_close
+def unwind_bets(client, bases: List[str], max_quantity: decimal.Decimal = None) -> decimal.Decimal:
+    """
+    Cancels the SL/TP legs of `bases` in bulk and closes what is left of
+    their positions with as few market orders as possible.
+
+    A bet whose legs were both cancelled here still holds its position,
+    of the legs' quantity. If one leg was already gone, it was filled and
+    the position is closed already. If both were, they are looked up: both
+    cancelled means an earlier attempt cancelled them and failed before
+    closing the position, so it is still held, and unknown means the bet
+    never got its legs and holds nothing. The net of the still held
+    positions is closed in orders of at most `max_quantity`, and never more
+    than the symbol's MARKET lot limit. Returns the closed net quantity.
+    """
+    # Both legs of a bet go into the same request, so a reconciliation
+    # never sees one of them cancelled and the other still open.
+    legs = [get_client_order_id(base, role) for base in bases
+            for role in (OrderRole.STOP_LOSS, OrderRole.TAKE_PROFIT)]
+    results = cancel_orders_batch(client, legs, client.symbol)
+    registry = order_registry(client.symbol)
+    for leg in legs:
+        registry.closed(leg)
+    net = decimal.Decimal(0)
+    for base in bases:
+        stop_loss = results[get_client_order_id(base, OrderRole.STOP_LOSS)]
+        take_profit = results[get_client_order_id(base, OrderRole.TAKE_PROFIT)]
+        if "code" in stop_loss and "code" in take_profit:
+            try:
+                stop_loss, take_profit = (
+                    client.signed_request("GET", "/fapi/v1/order", {
+                        "symbol": client.symbol, "origClientOrderId": get_client_order_id(base, role)})
+                    for role in (OrderRole.STOP_LOSS, OrderRole.TAKE_PROFIT)
+                )
+            except Exception as e:
+                # The legs are cancelled already, the other bets still get closed.
+                if isinstance(e, BinanceApiException) and error_code(e) == -2013:  # Order does not exist.
+                    logger.info("Bet %s has no legs, no position to close", base)
+                else:
+                    logger.exception("Unable to look up the legs of bet %s, its position is left as is", base)
+                continue
+            if stop_loss["status"] != "CANCELED" or take_profit["status"] != "CANCELED":
+                logger.info("Bet %s had a leg filled already: %s, %s", base, stop_loss["status"],
+                            take_profit["status"])
+                continue
+            logger.info("Legs of bet %s were cancelled before, its position is still held", base)
+        elif "code" in stop_loss or "code" in take_profit:
+            logger.info("Bet %s had a leg filled already: %r, %r", base, stop_loss, take_profit)
+            continue
+        # The legs close the position, so it is their quantity the other way round.
+        quantity = decimal.Decimal(stop_loss["origQty"])
+        net += quantity if stop_loss["side"] == OrderSide.SELL else -quantity
+    logger.info("Cancelled the legs of %d bets, residual position %s", len(bases), net)
+
+    limit = _rules.get(client, client.symbol).max_market_quantity
+    max_quantity = limit if max_quantity is None else min(max_quantity, limit)
+    remaining = net
+    part = 0
+    while remaining != 0:
+        quantity = max(-max_quantity, min(max_quantity, remaining))
+        post_market_order(client, get_client_order_id(f"X{bases[0]}-{part}", OrderRole.INITIAL_MKT), -quantity)
+        remaining -= quantity
+        part += 1
+    return net
+
+
+@client
+def check_open_orders(client) -> Tuple[List[int], List[Tuple[int, OrderRole]]]:
+    """
+    Gets a list of open orders from Binance, resyncs the order registry with
+    it and classifies the bets as
+      - still open, both legs are (we need to check if they have timed out).
+      - to close - one of the legs was triggered, so we need to close the
+        open leg, and check for the reward logic.
+
+    Between these full scans the registry is kept up to date incrementally,
+    see `single_legged_bets`.
+    """
+    orders = client.get_open_orders(client.symbol)
+    logger.info("Currently open %s orders: %d", client.symbol, len(orders))
+    # NB! This method should never run in parallel with the
+    # order creator, because stop order / take profit creation
+    # is not transactional, so, if runs in parallel, it is possible
+    # that this method will see only created stop-loss order, and
+    # it'll make a decision that take profit is already closed.
+    # But it was not created yet actually. See executor.OrderGate.
+    registry = order_registry(client.symbol)
+    registry.resync(order.clientOrderId for order in orders)
+    return registry.open_bets(), registry.single_legged()
@@ -1,34 +1,228 @@
-import random
-from typing import List
 import logging
 import json
+import queue
+import threading
+import time
 
 from web3 import Web3
+from web3.exceptions import TransactionNotFound
+
+from rate_limit import POLLING, SETTLEMENT
+from rpc_pool import EndpointPool, PooledProvider
 
 
 logger = logging.getLogger(__name__)
 
 
+class NonceManager:
+    """ Hands out nonces locally, resyncing from the node's pending count. """
+
+    def __init__(self, w3, address: str):
+        self.w3 = w3
+        self.address = address
+        self._lock = threading.Lock()
+        self._next = None
+        self.resync()
+
+    def resync(self, minimum: int = 0):
+        """
+        `minimum` is the first nonce not in use by us: a node behind the
+        others may count fewer pending transactions than we sent.
+        """
+        with self._lock:
+            pending = self.w3.eth.getTransactionCount(self.address, "pending")
+            self._next = max(pending, minimum)
+            logger.info("Nonce of %s resynced to %d (node: %d)", self.address, self._next, pending)
+
+    def take(self) -> int:
+        with self._lock:
+            nonce = self._next
+            self._next += 1
+            return nonce
+
+
+class PendingTransaction:
+    __slots__ = ("bounded_fn", "nonce", "gas_price", "hashes", "sent_at", "on_mined")
+
+    def __init__(self, bounded_fn, nonce: int, gas_price: int, on_mined=None):
+        self.bounded_fn = bounded_fn
+        self.nonce = nonce
+        self.gas_price = gas_price
+        self.hashes = []
+        self.sent_at = None
+        self.on_mined = on_mined
+
+
+class TransactionPipeline:
+    """
+    Sends contract calls in the background.
+
+    `submit` only queues the call. The sender thread signs it with the next
+    local nonce and broadcasts it. The receipt thread polls for it. If no
+    receipt shows up within `receipt_timeout`, the transaction is replaced:
+    same nonce, gas price raised by `gas_bump`. This way one dropped
+    transaction cannot stall every later nonce. A failed broadcast resyncs
+    the nonce from the node, never below the nonces still tracked here, and
+    the call is queued again.
+
+    Receipts are polled through `receipt_w3` if given: a burst of pending
+    transactions shouldn't spend the settlement budget on polling.
+    """
+
+    MAX_SEND_ATTEMPTS = 5
+
+    def __init__(self, w3, sender_address: str, private_key: str, chain_id: int = 97, gas: int = 200000,
+                 gas_price: int = 200 * 10**9, receipt_timeout: float = 60,
+                 gas_bump: float = 1.125, max_gas_price: int = 1000 * 10**9,
+                 poll_interval: float = 1.0, receipt_w3=None):
+        self.w3 = w3
+        self.receipt_w3 = receipt_w3 or w3
+        self.private_key = private_key
+        self.chain_id = chain_id
+        self.gas = gas
+        self.gas_price = gas_price
+        self.receipt_timeout = receipt_timeout
+        self.gas_bump = gas_bump
+        self.max_gas_price = max_gas_price
+        self.poll_interval = poll_interval
+        self.nonces = NonceManager(w3, sender_address)
+        self._queue = queue.Queue()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for target in (self._send_loop, self._receipt_loop):
+            thread = threading.Thread(target=target, name=f"tx-{target.__name__}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+        self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout=5)
+
+    def submit(self, bounded_fn, on_sent=None, on_mined=None):
+        """
+        `on_sent()` is called on the sender thread once the call is
+        broadcast, `on_mined()` on the receipt thread once it is mined
+        without a revert.
+        """
+        self._queue.put((bounded_fn, 0, on_sent, on_mined))
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() + len(self._pending)
+
+    def _send_loop(self):
+        while not self._stopped.is_set():
+            item = self._queue.get()
+            if item is None:
+                return
+            bounded_fn, attempt, on_sent, on_mined = item
+            tx = PendingTransaction(bounded_fn, self.nonces.take(), self.gas_price, on_mined)
+            try:
+                self._broadcast(tx)
+            except Exception as e:
+                logger.warning("Unable to send transaction with nonce %d: %s", tx.nonce, e)
+                with self._pending_lock:
+                    in_use = max(self._pending, default=-1) + 1
+                self.nonces.resync(in_use)
+                if attempt + 1 < self.MAX_SEND_ATTEMPTS:
+                    self._queue.put((bounded_fn, attempt + 1, on_sent, on_mined))
+                else:
+                    logger.error("Giving up on %s after %d attempts", bounded_fn.fn_name, attempt + 1)
+                continue
+            with self._pending_lock:
+                self._pending[tx.nonce] = tx
+            if on_sent is not None:
+                on_sent()
+
+    def _broadcast(self, tx: PendingTransaction):
+        txn = tx.bounded_fn.buildTransaction(
+            {
+                "chainId": self.chain_id,
+                "gas": self.gas,
+                "gasPrice": tx.gas_price,
+                "nonce": tx.nonce,
+            }
+        )
+        signed_txn = self.w3.eth.account.sign_transaction(txn, private_key=self.private_key)
+        tx.hashes.append(self.w3.eth.sendRawTransaction(signed_txn.rawTransaction))
+        tx.sent_at = time.monotonic()
+        logger.debug("Sent %s nonce=%d gasPrice=%d", tx.bounded_fn.fn_name, tx.nonce, tx.gas_price)
+
+    def _receipt_loop(self):
+        while not self._stopped.wait(self.poll_interval):
+            with self._pending_lock:
+                pending = list(self._pending.values())
+            for tx in pending:
+                try:
+                    self._check(tx)
+                except Exception:
+                    logger.exception("Unable to track transaction with nonce %d", tx.nonce)
+
+    def _check(self, tx: PendingTransaction):
+        for tx_hash in tx.hashes:
+            try:
+                receipt = self.receipt_w3.eth.getTransactionReceipt(tx_hash)
+            except TransactionNotFound:
+                continue
+            if receipt is None:
+                continue
+            with self._pending_lock:
+                self._pending.pop(tx.nonce, None)
+            if receipt["status"] != 1:
+                logger.error("Transaction %s (%s) reverted", tx_hash.hex(), tx.bounded_fn.fn_name)
+            elif tx.on_mined is not None:
+                tx.on_mined()
+            return
+
+        if time.monotonic() - tx.sent_at < self.receipt_timeout:
+            return
+        tx.gas_price = min(int(tx.gas_price * self.gas_bump) + 1, self.max_gas_price)
+        logger.warning("No receipt for nonce %d, replacing with gasPrice=%d", tx.nonce, tx.gas_price)
+        try:
+            self._broadcast(tx)
+        except Exception as e:
+            # Most likely "nonce too low": one of the hashes is being mined.
+            logger.warning("Unable to replace nonce %d: %s", tx.nonce, e)
+            tx.sent_at = time.monotonic()
+
+
 class ContractCaller:
     def __init__(
         self,
-        entrypoints: List[str],
+        rpc_pool: EndpointPool,
         contract_address: str,
         sender_address: str,
         private_key: str,
+        gas_price_gwei: int = 200,
+        receipt_timeout: float = 60,
     ):
-        self.entrypoint = entrypoints
         self.contract_address = contract_address
         self.private_key = private_key
-        self.w3 = self.init_entrypoint(entrypoints)
+        self.w3 = self.init_entrypoint(rpc_pool)
+        # Sending and nonces go first, receipt polling waits with the log polling.
+        receipt_w3 = Web3(PooledProvider(rpc_pool, priority=POLLING))
         with open("abi.json") as abi_file:
             abi = json.load(abi_file)
         self.contract = self.w3.eth.contract(address=contract_address, abi=abi)
-        self.nonce = self.w3.eth.getTransactionCount(sender_address)
-        logger.debug("Started ContractCaller, nonce=%d", self.nonce)
+        self.pipeline = TransactionPipeline(
+            self.w3,
+            sender_address,
+            private_key,
+            gas_price=Web3.toWei(gas_price_gwei, "gwei"),
+            receipt_timeout=receipt_timeout,
+            receipt_w3=receipt_w3,
+        )
+        self.pipeline.start()
+        logger.debug("Started ContractCaller")
 
-    def on_bet_accepted(self, bet_id):
-        self.make_call(self.contract.functions.betAccepted(bet_id, 1, 0, 2))
+    def on_bet_accepted(self, bet_id, on_sent=None, on_mined=None):
+        self.make_call(self.contract.functions.betAccepted(bet_id, 1, 0, 2), on_sent, on_mined)
 
     def mark_bet_as_expired(self, bet_id):
         self.make_call(self.contract.functions.betCanceled(bet_id))
@@ -39,29 +233,14 @@ class ContractCaller:
     def mark_bet_as_lost(self, bet_id, closing_price, amount):
         self.make_call(self.contract.functions.betLost(bet_id, closing_price, amount))
 
-    def make_call(self, bounded_fn):
-        txn = bounded_fn.buildTransaction(
-            {
-                "chainId": 97,
-                "gas": 200000,
-                "gasPrice": Web3.toWei("200", "gwei"),
-                "nonce": self.nonce,
-            }
-        )
-        signed_txn = self.w3.eth.account.sign_transaction(txn, private_key=self.private_key)
-        self.w3.eth.sendRawTransaction(signed_txn.rawTransaction)
-        self.nonce = self.nonce + 1
+    def make_call(self, bounded_fn, on_sent=None, on_mined=None):
+        self.pipeline.submit(bounded_fn, on_sent, on_mined)
 
-    def init_entrypoint(self, entrypoints: List[str]):
-        while entrypoints:
-            candidate = random.choice(entrypoints)
-            w3 = Web3(Web3.HTTPProvider(candidate))
-            try:
-                if w3.isConnected():
-                    logger.info("Found active entry point %s", candidate)
-                    return w3
-            except Exception:
-                entrypoints.remove(candidate)
-                logger.info("Unable to connect to entrypoint %s", candidate)
-        else:
+    def close(self):
+        self.pipeline.stop()
+
+    def init_entrypoint(self, rpc_pool: EndpointPool):
+        w3 = Web3(PooledProvider(rpc_pool, priority=SETTLEMENT))
+        if not w3.isConnected():
             raise RuntimeError("No active entrypoints")
+        return w3
@@ -0,0 +1,100 @@
+"""
+One-pass batch decoder for the contract's bet lifecycle logs.
+
+`decode_logs` turns raw logs into a columnar `LogBatch`, one list per field.
+BetPlaced logs also get a slotted `PlacedBet`, which is stored as a plain
+row (`PlacedBet.columns`) without building an ORM object.
+"""
+
+import datetime
+
+from hexbytes import HexBytes
+
+from models import EventKind
+
+
+BET_PLACED_TOPIC = "0x4f1eed5e863a822b0f9eb960dfdab2cc5a99beec4b191f2a7a9c7e28e5a15524"
+BET_ACCEPTED_TOPIC = "0x53df379b69179f91bf7e57d5d0dfb75c8108aac2832ac67a7863b33d610f9c9c"
+BET_WON_TOPIC = "0x97d038bd771240fad626f652b68259f54d6184295a3a08bc4a4194210c66e8b3"
+BET_LOST_TOPIC = "0x9dc82e14e977affd703d8bbce05d248bd8296aebfd0a2ee3fa1bc32081edfe76"
+BET_CANCELED_TOPIC = "0x0251581e1b59903a31a6bd345b77ac977d80257865ab48261eed09027158d561"
+
+LIFECYCLE_TOPICS = {
+    HexBytes(BET_PLACED_TOPIC): EventKind.PLACED,
+    HexBytes(BET_ACCEPTED_TOPIC): EventKind.ACCEPTED,
+    HexBytes(BET_WON_TOPIC): EventKind.WON,
+    HexBytes(BET_LOST_TOPIC): EventKind.LOST,
+    HexBytes(BET_CANCELED_TOPIC): EventKind.CANCELED,
+}
+
+
+class PlacedBet:
+    """ A decoded BetPlaced log, with the same attribute names as `Bet`. """
+
+    __slots__ = ("id", "tx", "sender", "amount", "created", "direction")
+
+    def __init__(self, id, tx, sender, amount, created, direction):
+        self.id = id
+        self.tx = tx
+        self.sender = sender
+        self.amount = amount
+        self.created = created
+        self.direction = direction
+
+    def columns(self) -> dict:
+        """ The `Bet` row. """
+        return dict(id=self.id, tx=self.tx, sender=self.sender, amount=self.amount,
+                    created=self.created, direction=self.direction)
+
+    def __repr__(self):
+        return f"PlacedBet(id={self.id}, direction={self.direction}, amount={self.amount.hex()})"
+
+
+class LogBatch:
+    __slots__ = ("blocks", "log_indexes", "kinds", "bet_ids", "txs", "placed")
+
+    def __init__(self):
+        self.blocks = []
+        self.log_indexes = []
+        self.kinds = []
+        self.bet_ids = []
+        self.txs = []
+        self.placed = []
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def max_block(self) -> int:
+        return max(self.blocks, default=0)
+
+    def index_rows(self):
+        """ Rows for `models.index_events`. """
+        return [
+            dict(block=block, log_index=log_index, kind=kind, bet_id=bet_id, tx=tx)
+            for block, log_index, kind, bet_id, tx
+            in zip(self.blocks, self.log_indexes, self.kinds, self.bet_ids, self.txs)
+        ]
+
+
+def decode_logs(logs) -> LogBatch:
+    batch = LogBatch()
+    created = datetime.datetime.utcnow()
+    placed = EventKind.PLACED
+    for log in logs:
+        topics = log["topics"]
+        kind = LIFECYCLE_TOPICS[topics[0]]
+        bet_id = int.from_bytes(topics[1], "big")
+        tx = log["transactionHash"]
+        batch.blocks.append(log["blockNumber"])
+        batch.log_indexes.append(log["logIndex"])
+        batch.kinds.append(kind.value)
+        batch.bet_ids.append(bet_id)
+        batch.txs.append(tx)
+        if kind is placed:
+            data = log["data"]
+            # web3 gives the data as a hex string, newer releases as bytes.
+            raw = bytes.fromhex(data[2:]) if isinstance(data, str) else bytes(data)
+            batch.placed.append(PlacedBet(
+                bet_id, tx, bytes(topics[2][-20:]), raw[32:64], created, int.from_bytes(raw[:32], "big"),
+            ))
+    return batch
@@ -0,0 +1,57 @@
+"""
+Bounded set of the bet ids we already hedged and stored.
+
+`EventProvider.process_result` drops re-delivered BetPlaced events
+(overlapping ranges, restarts, reorgs) against it before any exchange call.
+Only the most recent `capacity` ids are kept. An older bet delivered again
+still meets the duplicate client order id on the exchange and the ignored
+duplicate row.
+"""
+
+from collections import OrderedDict
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class SeenBets:
+    def __init__(self, capacity: int = 100000):
+        self.capacity = capacity
+        self._ids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, bet_id: int) -> bool:
+        if bet_id in self._ids:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, bet_id: int):
+        self._ids[bet_id] = None
+        self._ids.move_to_end(bet_id)
+        while len(self._ids) > self.capacity:
+            self._ids.popitem(last=False)
+
+    def discard(self, bet_id: int):
+        self._ids.pop(bet_id, None)
+
+    def load(self, bet_ids):
+        """ bet_ids oldest first, see `models.get_recent_bet_ids`. """
+        for bet_id in bet_ids:
+            self.add(bet_id)
+        logger.info("Preloaded %d known bet ids", len(self._ids))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._ids),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
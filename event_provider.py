@@ -1,103 +1,284 @@
 import asyncio
-import datetime
-from typing import List
-import random
+from collections import OrderedDict
 import logging
-import struct
 import time
 
-from hexbytes import HexBytes
-from sqlalchemy.exc import IntegrityError
 from web3 import Web3
 
 
-from models import Bet, create_bet, rollback_session, set_last_processed_block
+from backfill import Backfiller
+from decoder import LIFECYCLE_TOPICS, PlacedBet, decode_logs
+from executor import RPC
+import metrics
+from models import EventKind, Outcome, UnitOfWork, get_placed_bet_ids, rewind_after_reorg
+from rate_limit import POLLING
+from rpc_pool import EndpointPool, PooledProvider
 
 
 logger = logging.getLogger(__name__)
-BET_PLACED_TOPIC = "0x4f1eed5e863a822b0f9eb960dfdab2cc5a99beec4b191f2a7a9c7e28e5a15524"
+
+# Bets the contract settled get their outcome right away, they don't expire.
+SETTLED_OUTCOMES = {EventKind.WON.value: Outcome.WIN, EventKind.LOST.value: Outcome.LOSE}
 
 
 class EventProvider:
-    def __init__(self, entrypoints: List[str], contract_address: str, first_block: int, reactor):
-        self.w3 = self.init_entrypoint(entrypoints)
-        self.event_filter = self.init_filter(self.w3, contract_address, first_block + 1)
+    # Block mode: how many processed block hashes are kept to find a reorg's fork point.
+    REORG_WINDOW = 128
+    CYCLE_SECONDS = 30
+    # Backoff before delivering a failed batch again, doubled up to the max.
+    RETRY_SECONDS = 1.0
+    MAX_RETRY_SECONDS = 60.0
+
+    def __init__(self, rpc_pool: EndpointPool, contract_address: str, first_block: int, reactor, executor,
+                 concurrency: int = 1, backfill_chunk: int = 2000, backfill_concurrency: int = 4,
+                 ingestion: str = "filter", confirmations: int = 1):
+        self.rpc_pool = rpc_pool
+        self.w3 = self.init_entrypoint(rpc_pool)
+        self.contract_address = contract_address
+        # The last block whose events were completely processed.
+        self.last_block = first_block
+        self.event_filter = None
         self.reactor = reactor
+        self.executor = executor
+        self.backfiller = Backfiller(
+            self.w3, executor, contract_address, self.topics(),
+            chunk=backfill_chunk, concurrency=backfill_concurrency,
+        )
+        # Bounds the number of bets hedged at the same time.
+        self.bet_slots = asyncio.Semaphore(concurrency)
+        # "filter" polls getFilterChanges every 30 seconds, "blocks" follows new heads.
+        self.ingestion = ingestion
+        self.confirmations = confirmations
+        self.block_hashes = OrderedDict()
+        # Endpoint url -> a `Web3` pinned to it, see `pinned_w3`.
+        self.pinned = {}
+        # Bets a reorganization orphaned -> the block the new chain is checked up to for them.
+        self.orphaned = {}
+        # When the head being processed was noticed, the start of the bets' stage timings.
+        self.head_seen_at = None
 
-    def init_entrypoint(self, entrypoints: List[str]):
-        while entrypoints:
-            candidate = random.choice(entrypoints)
-            w3 = Web3(Web3.HTTPProvider(candidate))
-            try:
-                if w3.isConnected():
-                    logger.info("Found active entry point %s", candidate)
-                    return w3
-            except Exception:
-                entrypoints.remove(candidate)
-                logger.info("Unable to connect to entrypoint %s", candidate)
-        else:
+    def init_entrypoint(self, rpc_pool: EndpointPool):
+        w3 = Web3(PooledProvider(rpc_pool, priority=POLLING))
+        if not w3.isConnected():
             raise RuntimeError("No active entrypoints")
+        return w3
+
+    @staticmethod
+    def topics():
+        # Any lifecycle event, they all go to the local index.
+        return [[topic.hex() for topic in LIFECYCLE_TOPICS]]
 
     def init_filter(self, w3, contract_address: str, first_block: int):
         logger.info("Log filtering will start from block %d", first_block)
         return w3.eth.filter({
             "address": contract_address,
-            "fromBlock": first_block + 1,
-            "topics": [BET_PLACED_TOPIC]
+            "fromBlock": first_block,
+            "topics": self.topics(),
         })
 
     async def run(self):
-        logger.info("Running initial filter")
-        result = self.w3.eth.getFilterLogs(self.event_filter.filter_id)
-        await self.process_result(result)
+        if self.ingestion == "blocks":
+            return await self.follow_blocks()
+        try:
+            await self.catch_up()
+        except Exception:
+            logger.exception("Unable to catch up from block %d", self.last_block + 1)
+            await self.redeliver()
         while True:
-            logger.info("Fetching updates")
-            result = self.w3.eth.getFilterChanges(self.event_filter.filter_id)
-            await self.process_result(result)
             await asyncio.sleep(30)
+            logger.info("Fetching updates, RPC pool: %r", self.rpc_pool.stats())
+            try:
+                result = await self.executor.run(RPC, self.w3.eth.getFilterChanges, self.event_filter.filter_id)
+            except Exception as e:
+                # The filter only exists on the node that created it.
+                logger.warning("Filter is lost (%s), catching up from block %d", e, self.last_block + 1)
+                await self.redeliver(delay=0)
+                continue
+            try:
+                await self.process_result(result)
+            except Exception:
+                logger.exception("Unable to process the logs after block %d", self.last_block)
+                await self.redeliver()
 
-    @staticmethod
-    def decode_event(event) -> Bet:
-        bet_id_raw, user = event.topics[1:3]
-        user = user[-20:]
-        bet_id = 0
-        for bet_id_8b_chunk in struct.unpack('>4Q', bet_id_raw):
-            bet_id = bet_id * 2**64 + bet_id_8b_chunk
-        data_offset = 2  # to adjust 0x
-        next_field_size = 64
-        direction = int(event.data[data_offset:data_offset+next_field_size], 16)
-        data_offset += next_field_size
-        next_field_size = 64
-        amount = HexBytes(event.data[data_offset:data_offset+next_field_size])
-        res = dict(id=bet_id, tx=event.transactionHash, sender=user, amount=amount,
-                   created=datetime.datetime.utcnow(), direction=direction)
-        logger.info('Received Bet %s', res)
-        return Bet(**res)
-        
-    async def process_result(self, result):
-        logger.info('processing %s', result)
-        max_block_num = 0
-        for event in result:
-            bet = self.decode_event(event)
+    async def redeliver(self, delay: float = RETRY_SECONDS):
+        """
+        Delivers everything after `last_block` again, with `catch_up`, after
+        `delay` seconds. Each failure doubles the delay.
+        """
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                return await self.catch_up()
+            except Exception:
+                delay = min(max(delay * 2, self.RETRY_SECONDS), self.MAX_RETRY_SECONDS)
+                logger.exception("Unable to catch up from block %d, retrying in %ss", self.last_block + 1, delay)
+
+    async def catch_up(self):
+        """
+        Backfills everything after `last_block` in chunks, then installs the
+        filter for the blocks after that.
+        """
+        head = await self.executor.run(RPC, lambda: self.w3.eth.blockNumber)
+        logger.info("Catching up on blocks %d..%d", self.last_block + 1, head)
+        await self.backfiller.run(self.last_block + 1, head, self.process_backfill)
+        self.event_filter = await self.executor.run(RPC, self.init_filter, self.w3, self.contract_address, head + 1)
+        # Blocks mined while the filter was being installed.
+        result = await self.executor.run(RPC, self.w3.eth.getFilterLogs, self.event_filter.filter_id)
+        await self.process_result(result)
 
+    async def follow_blocks(self):
+        """
+        Polls the head with an interval adapted to the observed block time,
+        and processes blocks as soon as they have `confirmations` blocks on
+        top of them. Before each step the last processed block's hash is
+        checked again, to rewind past a reorganization. The bets it orphaned
+        are unwound once the new chain is processed as far as the old one
+        was, unless they were mined again. A failed step is retried from
+        the block after `last_block`, with a backoff.
+        """
+        block_time = 3.0
+        seen_head, seen_at = None, time.monotonic()
+        last_cycle = 0.0
+        retry = self.RETRY_SECONDS
+        while True:
+            try:
+                w3 = self.pinned_w3()
+                head = await self.executor.run(RPC, lambda: w3.eth.blockNumber)
+                now = time.monotonic()
+                if seen_head is not None and head > seen_head:
+                    block_time += 0.2 * ((now - seen_at) / (head - seen_head) - block_time)
+                if seen_head is None or head > seen_head:
+                    seen_head, seen_at = head, now
+                    self.head_seen_at = now
+
+                target = head - self.confirmations
+                if target > self.last_block:
+                    await self.check_reorg(w3)
+                    # Hashed before its logs are read: a reorganization in between
+                    # then shows up as a fork on the next step, instead of going unseen.
+                    block = await self.executor.run(RPC, w3.eth.getBlock, target)
+                    await self.backfiller.run(self.last_block + 1, target, self.process_backfill, w3)
+                    self.remember_block(target, block["hash"])
+                    await self.drop_orphaned()
+                if now - last_cycle >= self.CYCLE_SECONDS:
+                    logger.info("Following blocks at %d, RPC pool: %r", self.last_block, self.rpc_pool.stats())
+                    await self.reactor.on_cycle_finished()
+                    last_cycle = now
+            except Exception:
+                logger.exception("Unable to process the blocks after %d, retrying in %ss", self.last_block, retry)
+                await asyncio.sleep(retry)
+                retry = min(retry * 2, self.MAX_RETRY_SECONDS)
+                continue
+            retry = self.RETRY_SECONDS
+            await asyncio.sleep(min(max(block_time / 4, 0.2), 3.0))
+
+    def pinned_w3(self):
+        """ A `Web3` bound to the best ranked endpoint, for one step. """
+        endpoint = self.rpc_pool.ranked()[0]
+        if endpoint.url not in self.pinned:
+            self.pinned[endpoint.url] = Web3(PooledProvider(self.rpc_pool, priority=POLLING, endpoint=endpoint))
+        return self.pinned[endpoint.url]
+
+    def remember_block(self, number: int, block_hash):
+        self.block_hashes[number] = block_hash
+        while len(self.block_hashes) > self.REORG_WINDOW:
+            self.block_hashes.popitem(last=False)
+
+    async def check_reorg(self, w3):
+        if self.last_block not in self.block_hashes:
+            return
+        fork_point = None
+        for number in reversed(list(self.block_hashes)):
+            block = await self.executor.run(RPC, w3.eth.getBlock, number)
+            if block["hash"] == self.block_hashes[number]:
+                fork_point = number
+                break
+            del self.block_hashes[number]
+        if fork_point == self.last_block:
+            return
+        if fork_point is None:
+            fork_point = self.last_block - self.REORG_WINDOW
+        orphaned = await rewind_after_reorg(fork_point)
+        logger.warning("Chain reorganized after block %d (we were at %d), orphaned bets: %r",
+                       fork_point, self.last_block, orphaned)
+        for bet_id in orphaned:
+            self.orphaned.setdefault(bet_id, self.last_block)
+        self.last_block = fork_point
+
+    async def drop_orphaned(self):
+        due = [bet_id for bet_id, block in self.orphaned.items() if block <= self.last_block]
+        if not due:
+            return
+        mined_again = await get_placed_bet_ids(due)
+        gone = [bet_id for bet_id in due if bet_id not in mined_again]
+        if gone:
+            await self.reactor.on_bets_orphaned(gone)
+        for bet_id in due:
+            del self.orphaned[bet_id]
+
+    async def process_backfill(self, result, last_block: int):
+        await self.process_result(result, checkpoint=last_block, finish_cycle=False, seen_at=self.head_seen_at)
+
+    async def process_result(self, result, checkpoint: int = 0, finish_cycle: bool = True, seen_at: float = None):
+        timer = metrics.BetTimer(seen_at)
+        batch = decode_logs(result)
+        logger.info("Processing %d logs, %d bets placed", len(batch), len(batch.placed))
+        # The same bet twice in one batch would race with itself.
+        bets = {}
+        seen = self.reactor.seen
+        for bet in batch.placed:
+            if seen is not None and bet.id in seen:
+                continue
+            bets.setdefault(bet.id, bet)
+        if len(bets) < len(batch.placed):
+            logger.info("Skipped %d known or repeated bets", len(batch.placed) - len(bets))
+        if bets:
+            timer.mark("seen", len(bets))
+            timer.mark("decoded", len(bets))
+
+        uow = UnitOfWork()
+        if self.reactor.netting and bets:
+            await self.reactor.on_bets_netted(list(bets.values()), uow, timer)
+            handler = self.reactor.on_bet_hedged
+        else:
+            handler = self.reactor.on_bet_created
+        outcomes = await asyncio.gather(
+            *(self.process_bet(bet, handler, uow, timer) for bet in bets.values()), return_exceptions=True
+        )
+        failed = sum(isinstance(outcome, BaseException) for outcome in outcomes)
+        if failed:
+            metrics.counter("bets_failed_total", "Bets whose hedging failed, to be delivered again").inc(failed)
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                # Keep the bets that were hedged, but not the checkpoint:
+                # the failed ones have to be delivered again.
+                await uow.commit()
+                self.reactor.on_stored(uow)
+                raise outcome
+
+        max_block_num = max(batch.max_block(), checkpoint)
+        for bet_id, kind in zip(batch.bet_ids, batch.kinds):
+            if kind in SETTLED_OUTCOMES:
+                uow.set_outcome(bet_id, SETTLED_OUTCOMES[kind])
+        uow.index_events(batch.index_rows())
+        uow.checkpoint(max_block_num)
+        await uow.commit()
+        if uow.bets:
+            timer.mark("committed", len(uow.bets))
+        self.reactor.on_stored(uow)
+        self.last_block = max(self.last_block, max_block_num)
+        if finish_cycle:
+            # After the commit: delivering the batch again would hedge its bets twice.
+            try:
+                await self.reactor.on_cycle_finished()
+            except Exception:
+                logger.exception("Unable to finish the cycle after block %d", self.last_block)
+
+    async def process_bet(self, bet: PlacedBet, handler, uow: UnitOfWork, timer: metrics.BetTimer = None):
+        async with self.bet_slots:
             # Not trying to store a bet before a bet is actually made.
             # Otherwise we are at risk of not sending the bet to the exchange.
-            # This may end up in creating two bets. But this can be handled
-            # by the duplicate error exception handler.
-            try:
-                self.reactor.on_bet_created(bet)
-            except IntegrityError as e:
-                if e.orig.args[0] == 1062:
-                    # Optimistic concurrency control, as this should not happen very ofnet.
-                    logger.warn("Bet %d already exists. Removing orders...", bet.id)
-                    self.clean_up()
-                else:
-                    raise
-
-            max_block_num = max(max_block_num, event["blockNumber"])
-        
-        self.reactor.on_cycle_finished()
-        set_last_processed_block(max_block_num)
-
-    def clean_up(self):
-        rollback_session()
+            # This may end up in hedging a bet twice after a crash, the
+            # exchange rejects the duplicate client order id then, and the
+            # unit of work ignores the duplicate row.
+            await handler(bet, uow, timer=timer)
@@ -0,0 +1,90 @@
+"""
+Awaitable wrappers over the blocking exchange and chain calls.
+
+Every lane is a bounded thread pool, so a slow Binance response only holds
+its own lane while the event loop keeps polling events and sweeping stale
+bets. The exchange lane may run several bets at once; `OrderGate` keeps
+`check_open_orders` away from half-created SL/TP pairs (see the note in
+`check_open_orders`). The database is natively async, see `models`.
+"""
+
+import asyncio
+import contextlib
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+EXCHANGE = "exchange"
+CHAIN = "chain"
+RPC = "rpc"
+
+DEFAULT_WORKERS = {
+    EXCHANGE: 1,
+    # ContractCaller only queues transactions, see TransactionPipeline.
+    CHAIN: 1,
+    RPC: 1,
+}
+
+
+class Executor:
+    def __init__(self, workers: dict = None):
+        workers = {**DEFAULT_WORKERS, **(workers or {})}
+        self._pools = {
+            lane: ThreadPoolExecutor(max_workers=count, thread_name_prefix=lane)
+            for lane, count in workers.items()
+        }
+        logger.debug("Started executor lanes %r", workers)
+
+    async def run(self, lane: str, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pools[lane], functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self):
+        for pool in self._pools.values():
+            pool.shutdown(wait=True)
+
+
+class OrderGate:
+    """
+    Readers-writer gate between order creation and open order checks.
+
+    Any number of `create_order` calls may run at once, while
+    `check_open_orders` waits until all of them are done and blocks new
+    ones until it has the snapshot. Waiting checks have priority, so a
+    steady stream of bets cannot starve them.
+    """
+
+    def __init__(self):
+        self._cond = asyncio.Condition()
+        self._creating = 0
+        self._checking = False
+        self._waiting_checks = 0
+
+    @contextlib.asynccontextmanager
+    async def creating(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self._checking and not self._waiting_checks)
+            self._creating += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._creating -= 1
+                self._cond.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def checking(self):
+        async with self._cond:
+            self._waiting_checks += 1
+            await self._cond.wait_for(lambda: not self._creating and not self._checking)
+            self._waiting_checks -= 1
+            self._checking = True
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._checking = False
+                self._cond.notify_all()
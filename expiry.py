@@ -0,0 +1,112 @@
+"""
+In-memory expiry schedule of the open bets.
+
+The open bets are loaded once at startup, new ones are added as they are
+stored and settled ones are dropped. A heap ordered by deadline tells how
+long to sleep until the next expiry, so bets expire on time without
+scanning the bets table. A batch that fails to expire is scheduled again
+`retry_seconds` later, but for the bets settled meanwhile.
+"""
+
+import asyncio
+import datetime
+import heapq
+import logging
+from typing import Dict, List
+
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiringBet:
+    __slots__ = ("id", "direction", "deadline")
+
+    def __init__(self, id: int, direction: int, deadline: datetime.datetime):
+        self.id = id
+        self.direction = direction
+        self.deadline = deadline
+
+    def __repr__(self):
+        return f"ExpiringBet({self.id}, deadline={self.deadline:%Y-%m-%d %H:%M:%S})"
+
+
+class ExpiryScheduler:
+    def __init__(self, timeout: datetime.timedelta, retry_seconds: float = 60):
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds
+        self.pending: Dict[int, ExpiringBet] = {}
+        # (deadline, bet id); dropped bets are skipped when they surface.
+        self._heap = []
+        # The batch being expired, less the bets dropped meanwhile.
+        self._expiring: Dict[int, ExpiringBet] = {}
+        self._changed = asyncio.Event()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, bet_id: int, direction: int, created: datetime.datetime):
+        if bet_id in self.pending:
+            return
+        self._schedule(ExpiringBet(bet_id, direction, created + self.timeout))
+
+    def _schedule(self, bet: ExpiringBet):
+        self.pending[bet.id] = bet
+        heapq.heappush(self._heap, (bet.deadline, bet.id))
+        if self._heap[0][1] == bet.id:
+            self._changed.set()  # The next expiry moved closer.
+
+    def discard(self, bet_id: int):
+        self.pending.pop(bet_id, None)
+        self._expiring.pop(bet_id, None)
+
+    def retry(self, bets):
+        """ Schedules `bets` again, `retry_seconds` from now. """
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.retry_seconds)
+        for bet in bets:
+            if bet.id not in self.pending:
+                bet.deadline = deadline
+                self._schedule(bet)
+
+    def load(self, bets):
+        """ Adds the open bets read from the database, see `models.get_open_bets`. """
+        for bet in bets:
+            self.add(bet.id, bet.direction, bet.created)
+        logger.info("Expiry schedule: %d open bets, next %r", len(self.pending), self.next())
+
+    def next(self):
+        while self._heap and self._heap[0][1] not in self.pending:
+            heapq.heappop(self._heap)
+        return self.pending[self._heap[0][1]] if self._heap else None
+
+    def pop_due(self, now: datetime.datetime) -> List[ExpiringBet]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, bet_id = heapq.heappop(self._heap)
+            bet = self.pending.pop(bet_id, None)
+            if bet is not None:
+                due.append(bet)
+        return due
+
+    async def run(self, on_expired):
+        """ Calls `on_expired(bets)` with every batch of bets whose deadline passed. """
+        while True:
+            due = self.pop_due(datetime.datetime.utcnow())
+            if due:
+                logger.info("Expiring %d bets", len(due))
+                self._expiring = {bet.id: bet for bet in due}
+                try:
+                    await on_expired(due)
+                except Exception:
+                    logger.exception("Unable to expire %d bets, retrying in %ss",
+                                     len(self._expiring), self.retry_seconds)
+                    self.retry(list(self._expiring.values()))
+                finally:
+                    self._expiring = {}
+                continue
+            bet = self.next()
+            delay = (bet.deadline - datetime.datetime.utcnow()).total_seconds() if bet else None
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
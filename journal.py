@@ -0,0 +1,175 @@
+"""
+Local append-only journal of the bets being hedged.
+
+Every bet gets an intent record before its first exchange call, then one
+record per completed step. A bet is STORED once it is both committed to the
+database and its betAccepted is mined, whichever comes last. On restart the
+bets without a STORED record are resumed from their last step, from the
+local file only: no exchange probing and no waiting for the blocks to be
+scanned again.
+
+The file is SQLite in WAL mode, each record is its own small transaction.
+With synchronous=NORMAL a record survives a crash of the process (not
+necessarily a power loss) and costs no fsync.
+"""
+
+import datetime
+import enum
+import json
+import logging
+import sqlite3
+import threading
+from typing import Dict, List
+
+from binance_wrappers import OrderRole
+from decoder import PlacedBet
+
+
+logger = logging.getLogger(__name__)
+
+
+class Step(enum.IntEnum):
+    INTENT = 1
+    MARKET_FILLED = 2
+    SL_PLACED = 3
+    TP_PLACED = 4
+    ACCEPTED = 5  # betAccepted mined
+    STORED = 6  # committed to the database and accepted on chain, the bet is done
+
+    @classmethod
+    def of_role(cls, role: OrderRole) -> "Step":
+        return {
+            OrderRole.INITIAL_MKT: cls.MARKET_FILLED,
+            OrderRole.STOP_LOSS: cls.SL_PLACED,
+            OrderRole.TAKE_PROFIT: cls.TP_PLACED,
+        }[role]
+
+
+class JournaledBet:
+    """ An in-flight bet as the journal left it. """
+
+    __slots__ = ("bet", "steps", "fill", "committed")
+
+    def __init__(self, bet: PlacedBet):
+        self.bet = bet
+        self.steps = set()
+        self.fill = None
+        # Committed to the database by this run, waiting for betAccepted.
+        self.committed = False
+
+    @property
+    def placed(self):
+        return tuple(role for role, step in ((OrderRole.STOP_LOSS, Step.SL_PLACED),
+                                             (OrderRole.TAKE_PROFIT, Step.TP_PLACED))
+                     if step in self.steps)
+
+    def __repr__(self):
+        return f"JournaledBet({self.bet.id}, steps={sorted(step.name for step in self.steps)})"
+
+
+def _encode_bet(bet: PlacedBet) -> str:
+    return json.dumps({
+        "id": bet.id,
+        "tx": bytes(bet.tx).hex(),
+        "sender": bytes(bet.sender).hex(),
+        "amount": bytes(bet.amount).hex(),
+        "created": bet.created.isoformat(),
+        "direction": bet.direction,
+    })
+
+
+def _decode_bet(data: str) -> PlacedBet:
+    row = json.loads(data)
+    return PlacedBet(
+        row["id"], bytes.fromhex(row["tx"]), bytes.fromhex(row["sender"]), bytes.fromhex(row["amount"]),
+        datetime.datetime.fromisoformat(row["created"]), row["direction"],
+    )
+
+
+class Journal:
+    def __init__(self, path: str):
+        self.path = path
+        # Records come from the event loop and the exchange lane threads.
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS journal ("
+                "seq INTEGER PRIMARY KEY, bet_id INTEGER NOT NULL, step INTEGER NOT NULL, data TEXT)"
+            )
+        self.in_flight: Dict[int, JournaledBet] = self._load()
+        logger.info("Journal %s: %d bets in flight", path, len(self.in_flight))
+
+    def _load(self) -> Dict[int, JournaledBet]:
+        with self._lock:
+            # Finished bets are not needed anymore.
+            self._conn.execute(
+                "DELETE FROM journal WHERE bet_id IN (SELECT bet_id FROM journal WHERE step = ?)",
+                (Step.STORED,),
+            )
+            rows = self._conn.execute("SELECT bet_id, step, data FROM journal ORDER BY seq").fetchall()
+        bets = {}
+        for bet_id, step, data in rows:
+            step = Step(step)
+            if step == Step.INTENT:
+                bets[bet_id] = JournaledBet(_decode_bet(data))
+                continue
+            bet = bets.get(bet_id)
+            if bet is None:
+                continue
+            bet.steps.add(step)
+            if step == Step.MARKET_FILLED:
+                bet.fill = json.loads(data)
+        return bets
+
+    def _insert(self, rows):
+        """ Under `_lock`. """
+        self._conn.executemany("INSERT INTO journal (bet_id, step, data) VALUES (?, ?, ?)", rows)
+
+    def _append(self, rows):
+        with self._lock:
+            self._insert(rows)
+
+    def begin(self, bet: PlacedBet):
+        self._append([(bet.id, Step.INTENT, _encode_bet(bet))])
+        self.in_flight[bet.id] = JournaledBet(bet)
+
+    def record(self, bet_id: int, step: Step, data: dict = None):
+        rows = [(bet_id, step, json.dumps(data) if data is not None else None)]
+        # Records come from the receipt thread too, the state changes with the rows.
+        with self._lock:
+            journaled = self.in_flight.get(bet_id)
+            if journaled is not None:
+                journaled.steps.add(step)
+                if step == Step.MARKET_FILLED:
+                    journaled.fill = data
+                if step == Step.ACCEPTED and journaled.committed:
+                    rows.append((bet_id, Step.STORED, None))
+                    del self.in_flight[bet_id]
+            self._insert(rows)
+
+    def recorder(self, bet_id: int):
+        """ A `record(role, data)` callback for `binance_wrappers.create_order`. """
+        return lambda role, data: self.record(bet_id, Step.of_role(role), data)
+
+    def stored(self, bet_ids: List[int]):
+        """ The bets were committed to the database; those already accepted on chain are done. """
+        rows = []
+        with self._lock:
+            for bet_id in bet_ids:
+                journaled = self.in_flight.get(bet_id)
+                if journaled is None:
+                    continue
+                if Step.ACCEPTED in journaled.steps:
+                    rows.append((bet_id, Step.STORED, None))
+                    del self.in_flight[bet_id]
+                else:
+                    journaled.committed = True
+            if rows:
+                self._insert(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -3,31 +3,46 @@ import asyncio
 import datetime
 import logging
 import sys
-import time
 
 import yaml
 
 from binance_wrappers import (
-    OrderRole,
     create_order,
+    create_market_order,
+    create_net_order,
+    get_mark_price,
     get_orders,
-    get_client_order_id,
     cancel_order,
     check_open_orders,
+    single_legged_bets,
+    unwind_bets,
+    setup_account,
+    start_mark_price_stream,
+    start_user_data_stream,
+    shutdown_clients,
+    DEFAULT_LEVERAGE,
 )
 from contract import ContractCaller
+from dedup import SeenBets
 from event_provider import EventProvider
+from executor import CHAIN, EXCHANGE, RPC, Executor
+from expiry import ExpiryScheduler
+from journal import Journal
+import metrics
 from reactor import Reactor
+from rpc_pool import EndpointPool
+from shards import shard_configs, start_shards, stop_shards
 from models import (
-    Bet,
-    create_bet,
-    expire_bet,
     init_db,
-    get_bet,
+    close_db,
     get_last_processed_block,
-    set_last_processed_block,
-    get_stale_bets,
-    BetDirection,
+    get_open_bets,
+    get_recent_bet_ids,
+    get_settled_on_chain,
+    get_netted_bets,
+    UnitOfWork,
+    EventKind,
+    Outcome,
 )
 
 
@@ -44,95 +59,155 @@ def extract_config():
     return config
 
 
-async def check_stale_bets_task(timeout, binance_config, contract_caller):
-    while True:
-        logging.debug("Checking for stale bets")
-        stale_bets = get_stale_bets(timeout)
-        for bet in stale_bets:
-            contract_caller.mark_bet_as_expired(bet.id)
-            expire_bet(bet.id)
-            base_id = f'{bet.id}'
-            logging.info("Processing stale bet %s", base_id)
-            for role in (OrderRole.STOP_LOSS, OrderRole.TAKE_PROFIT):
-                client_order_id = get_client_order_id(base_id, role)
-                try:
-                    cancel_order(binance_config, client_order_id)
-                except Exception as e:
-                    logging.warn(
-                        "Unable to cancel the order. "
-                        "Probably it was executed right now, but because "
-                        "we were trying to cancel it, that means, that "
-                        "we have a full right to claim it as an timed out. "
-                        "Error: %s", e)
-            
-            # Remove position
-            reversed_direction = BetDirection((bet.direction + 1) % 2)
-            create_order(binance_config, f"{bet.id}", reversed_direction)
-        await asyncio.sleep(60)
+async def expire_bets_task(expiry, contract_caller, executor, reactor):
+    expiry.load(await get_open_bets())
+
+    async def on_expired(stale_bets):
+        settled = await get_settled_on_chain([bet.id for bet in stale_bets])
+        uow = UnitOfWork()
+        try:
+            await unwind_stale_bets(stale_bets, settled, uow, contract_caller, executor, reactor)
+        finally:
+            # The outcomes known so far, in one transaction: the settled
+            # bets and the unwound ones. The rest keeps no outcome.
+            await uow.commit()
+            reactor.on_stored(uow)
+
+    await expiry.run(on_expired)
+
+
+async def unwind_stale_bets(stale_bets, settled, uow, contract_caller, executor, reactor):
+    """
+    Unwinds the expired bets together: one bulk cancel of their legs and
+    the smallest number of market orders for their combined position. Only
+    the bets actually closed get the TIMEOUT outcome, and then the chain is
+    told about them. If unwinding fails, nothing is.
+    """
+    to_unwind = []
+    for bet in stale_bets:
+        settled_by = settled.get(bet.id)
+        if settled_by in (EventKind.WON, EventKind.LOST):
+            # Already settled on chain, its legs were handled back then.
+            uow.set_outcome(bet.id, Outcome.WIN if settled_by == EventKind.WON else Outcome.LOSE)
+            continue
+        to_unwind.append(bet.id)
+    if not to_unwind:
+        return
+    logging.info("Unwinding %d stale bets", len(to_unwind))
+    closed = await reactor.unwind(to_unwind, uow)
+    left_open = set(to_unwind).difference(closed)
+    if left_open:
+        logging.warning("Stale bets %r were not unwound, they keep no outcome", sorted(left_open))
+    for bet_id in closed:
+        uow.set_outcome(bet_id, Outcome.TIMEOUT)
+
+    def notify():
+        for bet_id in closed:
+            # Cancelled on chain already, only our side was left.
+            if settled.get(bet_id) is None:
+                contract_caller.mark_bet_as_expired(bet_id)
+
+    await executor.run(CHAIN, notify)
 
 
 def main():
-    config = extract_config()
+    # The main shard runs here, with its share of the rate budgets too.
+    configs = shard_configs(extract_config())
+    # Every other market is hedged by a worker process of its own.
+    workers = start_shards(configs, run)
+    try:
+        run(configs[0])
+    finally:
+        stop_shards(workers)
+
+
+def run(config):
+    """ Runs the shard of one market: a bet contract and the futures symbol hedging it. """
+    if config.get("metrics", {}).get("port"):
+        metrics.start_server(config["metrics"]["port"], config["metrics"].get("host", "127.0.0.1"))
     init_db(config["db"])
+    concurrency = config["algo"].get("concurrency", 1)
+    backfill_concurrency = config["incoming"].get("backfill_concurrency", 4)
+    executor = Executor(workers={EXCHANGE: concurrency, RPC: backfill_concurrency})
 
+    # EventProvider and ContractCaller share the endpoint set and its budget.
+    rpc_pool = EndpointPool(config["incoming"]["rpc"], config["incoming"].get("rate_limits", []))
     contract_caller = ContractCaller(
-        config["incoming"]["rpc"],
+        rpc_pool,
         config["incoming"]["contract"],
         config["rewards"]["sender_address"],
         config["rewards"]["private_key"],
+        gas_price_gwei=config["rewards"].get("gas_price_gwei", 200),
+        receipt_timeout=config["rewards"].get("receipt_timeout", 60),
     )
 
+    loop = asyncio.get_event_loop()
+    mark_prices = start_mark_price_stream(config["binance"])
+    expiry = ExpiryScheduler(
+        datetime.timedelta(seconds=config["algo"]["timeout-seconds"]),
+        retry_seconds=config["algo"].get("expiry_retry_seconds", 60),
+    )
+    journal = Journal(config["db"]["journal"]) if config["db"].get("journal") else None
+    seen = SeenBets(config["algo"].get("seen_bets", 100000))
+    seen.load(loop.run_until_complete(get_recent_bet_ids(seen.capacity)))
     reactor = Reactor(
         config=config,
+        executor=executor,
         contract_caller=contract_caller,
         create_order=create_order,
         check_open_orders=check_open_orders,
         cancel_order=cancel_order,
+        mark_prices=mark_prices,
+        loop=loop,
+        create_net_order=create_net_order,
+        create_market_order=create_market_order,
+        get_mark_price=get_mark_price,
+        expiry=expiry,
+        single_legged=single_legged_bets,
+        unwind_bets=unwind_bets,
+        journal=journal,
+        seen=seen,
     )
+    if reactor.netting:
+        reactor.ledger.load(loop.run_until_complete(get_netted_bets()))
+    reactor.pushed_updates = start_user_data_stream(config["binance"], reactor.on_order_update) is not None
     events = EventProvider(
-        config["incoming"]["rpc"],
+        rpc_pool,
         config["incoming"]["contract"],
-        get_last_processed_block(config["incoming"]["first_block"]),
+        loop.run_until_complete(get_last_processed_block(config["incoming"]["first_block"])),
         reactor,
+        executor,
+        concurrency,
+        backfill_chunk=config["incoming"].get("backfill_chunk", 2000),
+        backfill_concurrency=backfill_concurrency,
+        ingestion=config["incoming"].get("ingestion", "filter"),
+        confirmations=config["incoming"].get("confirmations", 1),
     )
     
-    loop = asyncio.get_event_loop()
     loop.create_task(
-        check_stale_bets_task(
-            timeout=datetime.timedelta(seconds=config["algo"]["timeout-seconds"]),
-            binance_config=config["binance"],
+        expire_bets_task(
+            expiry=expiry,
             contract_caller=contract_caller,
+            executor=executor,
+            reactor=reactor,
         )
     )
 
+    setup_account(config["binance"], config["binance"].get("leverage", DEFAULT_LEVERAGE))
+    loop.create_task(reactor.resume_journaled())
     loop.create_task(events.run())
     get_orders(config["binance"])
 
-    loop.run_forever()
-    return
-    contract_caller.on_bet_accepted()
-
-
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(events.run())
-    return
-
-    cfg = config["binance"]
-    direction = BetDirection.DOWN
-    base_order_id = create_bet(direction, "AHHHHA")
-    base_order = create_order(cfg, base_order_id, direction)
-    stop_loss_price, take_profit_price = (
-        (
-            base_order.avgPrice * (1.0 - config["algo"]["safebelt-trigger"] / 100.0),
-            base_order.avgPrice * (1.0 + config["algo"]["win-trigger"] / 100.0),
-        )
-        if (direction == BetDirection.UP)
-        else (
-            base_order.avgPrice * (1.0 + config["algo"]["safebelt-trigger"] / 100.0),
-            base_order.avgPrice * (1.0 - config["algo"]["win-trigger"] / 100.0),
-        )
-    )
-
+    try:
+        loop.run_forever()
+    finally:
+        contract_caller.close()
+        executor.shutdown()
+        shutdown_clients()
+        metrics.stop_server()
+        loop.run_until_complete(close_db())
+        if journal is not None:
+            journal.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,182 @@
+"""
+In-process counters and latency histograms, served in the Prometheus text
+format from a small local HTTP endpoint.
+
+Recording is a bisect over the bucket bounds and an increment under the
+metric's own lock, a microsecond or so: cheap enough to stay on for every
+bet and every exchange/RPC request.
+"""
+
+import bisect
+import http.server
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers a local round trip up to a slow settlement.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Counter:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+    def render(self, name: str, labels: str):
+        yield f"{name}{{{labels}}} {self.value}" if labels else f"{name} {self.value}"
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, count: int = 1):
+        """ `count` observations of `value`, e.g. one per bet of a batch. """
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += count
+            self.sum += value * count
+
+    def render(self, name: str, labels: str):
+        with self._lock:
+            counts, total_sum = list(self.counts), self.sum
+        prefix = f"{labels}," if labels else ""
+        cumulative = 0
+        for bound, count in zip(self.bounds, counts):
+            cumulative += count
+            yield f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}'
+        cumulative += counts[-1]
+        yield f'{name}_bucket{{{prefix}le="+Inf"}} {cumulative}'
+        suffix = f"{{{labels}}}" if labels else ""
+        yield f"{name}_sum{suffix} {total_sum}"
+        yield f"{name}_count{suffix} {cumulative}"
+
+
+class Registry:
+    """ Metric families by name, each holding one metric per label set. """
+
+    def __init__(self):
+        self._families = {}  # name -> (type, help, {labels: metric})
+        self._lock = threading.Lock()
+
+    def _get(self, kind: str, cls, name: str, help: str, labels: dict):
+        key = tuple(sorted(labels.items()))
+        family = self._families.get(name)
+        metric = family[2].get(key) if family is not None else None
+        if metric is None:
+            with self._lock:
+                family = self._families.setdefault(name, (kind, help, {}))
+                metric = family[2].get(key)
+                if metric is None:
+                    metric = family[2][key] = cls()
+        return metric
+
+    def counter(self, name: str, help: str = "", **labels) -> Counter:
+        return self._get("counter", Counter, name, help, labels)
+
+    def histogram(self, name: str, help: str = "", **labels) -> Histogram:
+        return self._get("histogram", Histogram, name, help, labels)
+
+    def render(self) -> str:
+        with self._lock:
+            families = [(name, kind, help, list(metrics.items()))
+                        for name, (kind, help, metrics) in sorted(self._families.items())]
+        lines = []
+        for name, kind, help, metrics in families:
+            if help:
+                lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, metric in metrics:
+                labels = ",".join(f'{label}="{value}"' for label, value in key)
+                lines.extend(metric.render(name, labels))
+        return "\n".join(lines) + "\n"
+
+
+_registry = Registry()
+counter = _registry.counter
+histogram = _registry.histogram
+
+
+# The way of a bet through the bot, see `BetTimer`.
+STAGES = (
+    "seen",  # its logs were fetched
+    "decoded",
+    "leverage_set",
+    "mark_price",
+    "market_filled",
+    "sl_placed",
+    "tp_placed",
+    "accepted_sent",  # betAccepted broadcast
+    "committed",  # stored with its block checkpoint
+)
+_stages = {
+    stage: histogram("bet_stage_seconds", "Time from the bet's block being seen to each stage", stage=stage)
+    for stage in STAGES
+}
+
+
+class BetTimer:
+    """
+    Stage latencies of the bets of one batch, each measured from the moment
+    their block was seen. Safe to share between the bets and to use from
+    the executor threads.
+    """
+
+    __slots__ = ("started",)
+
+    def __init__(self, started: float = None):
+        self.started = time.monotonic() if started is None else started
+
+    def mark(self, stage: str, count: int = 1):
+        _stages[stage].observe(time.monotonic() - self.started, count)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = _registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+_server = None
+
+
+def start_server(port: int, host: str = "127.0.0.1"):
+    """ Serves GET /metrics on a daemon thread. """
+    global _server
+    _server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving metrics on http://%s:%d/metrics", host, _server.server_address[1])
+    return _server
+
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
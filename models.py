@@ -1,15 +1,22 @@
-import datetime
 from enum import Enum, auto
 import logging
 
-from sqlalchemy import Column, Integer, String, DateTime, CHAR, BINARY, update, text
+from sqlalchemy import Column, Index, Integer, Numeric, DateTime, CHAR, BINARY, cast, delete, func, select, update
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 
 
 _engine = None
-_session = None
+_sessions = None
+
+# Sync drivers of existing configs -> their asyncio counterparts.
+ASYNC_DRIVERS = {
+    "mysql": "mysql+aiomysql",
+    "mysql+pymysql": "mysql+aiomysql",
+    "sqlite": "sqlite+aiosqlite",
+}
 
 Base = declarative_base()
 
@@ -29,6 +36,17 @@ class Outcome(Enum):
     TIMEOUT = auto()
 
 
+class EventKind(Enum):
+    PLACED = 1
+    ACCEPTED = 2
+    WON = 3
+    LOST = 4
+    CANCELED = 5
+
+
+SETTLED_EVENTS = (EventKind.WON, EventKind.LOST, EventKind.CANCELED)
+
+
 class State(Base):
     __tablename__ = "state"
 
@@ -38,6 +56,7 @@ class State(Base):
 
 class Bet(Base):
     __tablename__ = "bets"
+    __table_args__ = (Index("ix_bets_outcome_created", "outcome", "created"),)
 
     id = Column(Integer, primary_key=True)
     # ex.: 0xfaafd0e5a2414ae8a9828d360d56a3e57e963b3e5b98b15c4145792e474ee025
@@ -52,65 +71,220 @@ class Bet(Base):
     outcome = Column(Integer)  # class Outcome
 
 
-def init_db(config: dict):
-    """ config should contain "conn" item """
-    global _engine
-    global _session
-    _engine = create_engine(config["conn"])
-    _session = sessionmaker(bind=_engine)()
-
+class BetEvent(Base):
+    """ Local index of the contract's bet lifecycle events. """
 
-def get_last_processed_block(default: int):
-    res = (
-        _session.query(State)
-        .filter_by(name=StateKeys.LAST_PROCESSED_BLOCK.value)
-        .first()
-    )
-    logging.debug("Got last processed block %r", res)
-    return int(res.value) if res is not None else default
+    __tablename__ = "bet_events"
+    __table_args__ = (Index("ix_bet_events_bet_id_kind", "bet_id", "kind"),)
 
-
-def set_last_processed_block(block: int):
-    _session.commit()
-    sql = (
-        f"INSERT INTO {State.__tablename__} ({State.name.key}, {State.value.key}) "
-        f"VALUES (:name, :value) "
-        f"ON DUPLICATE KEY UPDATE value = GREATEST(:value, value)"
-    )
-
-    with _engine.connect() as con:
-        logging.debug("Setting last processed block to %s %s", sql, (StateKeys.LAST_PROCESSED_BLOCK.value, block))
-        #con.execute(sql, {"name": StateKeys.LAST_PROCESSED_BLOCK.value, "value": block})
-        con.execute(text(sql), {"name": StateKeys.LAST_PROCESSED_BLOCK.value, "value": block})
-        con.commit()
-
-
-def create_bet(bet: Bet):
-    _session.add(bet)
-    _session.commit()
-    return bet.id
+    block = Column(Integer, primary_key=True)
+    log_index = Column(Integer, primary_key=True)
+    bet_id = Column(Integer, nullable=False)
+    kind = Column(Integer, nullable=False)  # class EventKind
+    tx = Column(BINARY(32), nullable=False)
 
 
-def rollback_session():
-    _session.rollback()
+class NettedBet(Base):
+    """ A netting mode ledger entry, see `netting.NettingLedger`. """
 
+    __tablename__ = "netted_bets"
 
-def get_bet(base):
-    bet = _session.query(Bet).filter_by(id=base).first()
-    return bet
+    bet_id = Column(Integer, primary_key=True)
+    direction = Column(Integer, nullable=False)  # class BetDirection
+    quantity = Column(Numeric(30, 10), nullable=False)
+    entry_price = Column(Numeric(30, 10), nullable=False)
+    stop_loss = Column(Numeric(30, 10), nullable=False)
+    take_profit = Column(Numeric(30, 10), nullable=False)
 
 
-def expire_bet(base):
-    stmt = update(Bet).where(Bet.id == base).values(outcome=Outcome.TIMEOUT.value)
-    _session.execute(stmt)
-    _session.commit()
+def init_db(config: dict):
+    """
+    config should contain "conn" item. Every call below gets its own session
+    from the engine's connection pool, so tasks can use the database at once.
+    """
+    global _engine
+    global _sessions
+    url = make_url(config["conn"])
+    url = url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+    options = {}
+    if url.get_backend_name() != "sqlite":
+        options = dict(
+            pool_size=config.get("pool_size", 5),
+            # Recycle connections before the server's wait_timeout closes them under us.
+            pool_recycle=config.get("pool_recycle", 3600),
+            pool_pre_ping=True,
+        )
+    _engine = create_async_engine(url, **options)
+    _sessions = async_sessionmaker(_engine, expire_on_commit=False)
+
+
+async def close_db():
+    await _engine.dispose()
+
+
+def _insert_ignore(session, table):
+    """ INSERT that skips rows whose key exists already. """
+    if session.bind.dialect.name == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    return mysql.insert(table).prefix_with("IGNORE")
+
+
+def _checkpoint_statement(session, block: int):
+    """ Upsert of the block cursor that never moves it backwards. """
+    values = dict(name=StateKeys.LAST_PROCESSED_BLOCK.value, value=block)
+    current = cast(State.value, Integer)
+    if session.bind.dialect.name == "sqlite":
+        stmt = sqlite.insert(State).values(**values)
+        return stmt.on_conflict_do_update(
+            index_elements=[State.name], set_=dict(value=func.max(current, cast(stmt.excluded.value, Integer))))
+    stmt = mysql.insert(State).values(**values)
+    return stmt.on_duplicate_key_update(value=func.greatest(current, cast(stmt.inserted.value, Integer)))
+
+
+async def get_last_processed_block(default: int):
+    async with _sessions() as session:
+        res = await session.get(State, StateKeys.LAST_PROCESSED_BLOCK.value)
+    logging.debug("Got last processed block %r", res)
+    return int(res.value) if res is not None else default
 
 
-def get_stale_bets(timeout):
-    now = datetime.datetime.utcnow()
-    bets = (
-        _session.query(Bet)
-        .filter(Bet.outcome == None, Bet.created < now - timeout)
-        .all()
-    )
-    return bets
+async def rewind_after_reorg(block: int):
+    """
+    Moves the block cursor back to `block` and forgets the events indexed
+    after it. Returns ids of the bets whose BetPlaced was orphaned.
+    """
+    async with _sessions.begin() as session:
+        orphaned = list(await session.scalars(
+            select(BetEvent.bet_id)
+            .where(BetEvent.block > block, BetEvent.kind == EventKind.PLACED.value)
+        ))
+        await session.execute(delete(BetEvent).where(BetEvent.block > block))
+        await session.execute(
+            update(State)
+            .where(State.name == StateKeys.LAST_PROCESSED_BLOCK.value)
+            .values(value=block)
+        )
+    return orphaned
+
+
+async def get_placed_bet_ids(bet_ids):
+    """ Those of `bet_ids` whose BetPlaced is indexed. """
+    if not bet_ids:
+        return set()
+    async with _sessions() as session:
+        return set(await session.scalars(
+            select(BetEvent.bet_id)
+            .where(BetEvent.bet_id.in_(bet_ids), BetEvent.kind == EventKind.PLACED.value)
+        ))
+
+
+async def get_bet(base):
+    async with _sessions() as session:
+        return await session.get(Bet, base)
+
+
+class UnitOfWork:
+    """
+    Collects the database writes of one `process_result` or stale sweep and
+    applies them in one transaction: bet inserts, outcome updates, indexed
+    events, netting ledger changes and the block checkpoint. The checkpoint
+    is committed together with the bets it covers, so a crash can't leave
+    one without the other.
+    """
+
+    def __init__(self):
+        self.bets = []
+        self.outcomes = {}
+        self.events = []
+        self.netted = []
+        self.unnetted = []
+        self.forgotten = []
+        self.block = None
+
+    def add_bet(self, row: dict):
+        """ row holds the Bet columns. """
+        self.bets.append(row)
+
+    def set_outcome(self, bet_id: int, outcome: Outcome):
+        self.outcomes[bet_id] = outcome
+
+    def index_events(self, rows):
+        self.events.extend(rows)
+
+    def add_netted(self, rows):
+        """ rows hold the NettedBet columns. """
+        self.netted.extend(rows)
+
+    def drop_netted(self, bet_ids):
+        self.unnetted.extend(bet_ids)
+
+    def forget_bets(self, bet_ids):
+        """ Deletes the bets, e.g. ones a reorganization took off the chain. """
+        self.forgotten.extend(bet_ids)
+
+    def checkpoint(self, block: int):
+        self.block = block if self.block is None else max(self.block, block)
+
+    async def commit(self):
+        if not (self.bets or self.outcomes or self.events or self.netted or self.unnetted or self.forgotten
+                or self.block is not None):
+            return
+        async with _sessions.begin() as session:
+            if self.bets:
+                # A bet re-delivered after a crash was hedged and stored already.
+                connection = await session.connection()
+                inserted = (await connection.execute(_insert_ignore(session, Bet), self.bets)).rowcount
+                if 0 <= inserted < len(self.bets):
+                    logging.warning("%d of %d bets already existed", len(self.bets) - inserted, len(self.bets))
+            by_outcome = {}
+            for bet_id, outcome in self.outcomes.items():
+                by_outcome.setdefault(outcome, []).append(bet_id)
+            for outcome, bet_ids in by_outcome.items():
+                await session.execute(update(Bet).where(Bet.id.in_(bet_ids)).values(outcome=outcome.value))
+            if self.events:
+                await session.execute(_insert_ignore(session, BetEvent), self.events)
+            if self.netted:
+                await session.execute(_insert_ignore(session, NettedBet), self.netted)
+            if self.unnetted:
+                await session.execute(delete(NettedBet).where(NettedBet.bet_id.in_(self.unnetted)))
+            if self.forgotten:
+                await session.execute(delete(Bet).where(Bet.id.in_(self.forgotten)))
+            if self.block is not None:
+                await session.execute(_checkpoint_statement(session, self.block))
+
+
+async def get_settled_on_chain(bet_ids):
+    """ bet id -> settling EventKind, for the bets the contract already settled. """
+    if not bet_ids:
+        return {}
+    async with _sessions() as session:
+        rows = await session.execute(
+            select(BetEvent.bet_id, BetEvent.kind)
+            .where(BetEvent.bet_id.in_(bet_ids), BetEvent.kind.in_([k.value for k in SETTLED_EVENTS]))
+        )
+        return {bet_id: EventKind(kind) for bet_id, kind in rows}
+
+
+async def get_open_bets():
+    """ Bets without an outcome, oldest first. """
+    async with _sessions() as session:
+        rows = await session.execute(
+            select(Bet.id, Bet.direction, Bet.created)
+            .where(Bet.outcome == None)
+            .order_by(Bet.created)
+        )
+        return rows.all()
+
+
+async def get_netted_bets():
+    """ The netting ledger as last committed. """
+    async with _sessions() as session:
+        return list(await session.scalars(select(NettedBet).order_by(NettedBet.bet_id)))
+
+
+async def get_recent_bet_ids(limit: int):
+    """ Ids of the last `limit` bets, oldest first. """
+    async with _sessions() as session:
+        ids = list(await session.scalars(select(Bet.id).order_by(Bet.id.desc()).limit(limit)))
+    ids.reverse()
+    return ids
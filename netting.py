@@ -0,0 +1,91 @@
+"""
+Local ledger for netting mode.
+
+In netting mode a batch of bets is hedged with one market order for the net
+quantity, and no SL/TP orders are placed on the exchange. Every bet keeps
+its own entry price and thresholds here instead, and `crossed` tells which
+bets the current price has settled.
+
+The ledger is kept in the `netted_bets` table as well, written in the same
+unit of work as the bets, and loaded back at startup.
+"""
+
+import decimal
+import logging
+from typing import Dict, List, Tuple
+
+from models import BetDirection
+
+
+logger = logging.getLogger(__name__)
+
+
+class LedgerEntry:
+    __slots__ = ("bet_id", "direction", "quantity", "entry_price", "stop_loss", "take_profit")
+
+    def __init__(self, bet_id: int, direction: BetDirection, quantity: decimal.Decimal,
+                 entry_price: decimal.Decimal, stop_loss: decimal.Decimal, take_profit: decimal.Decimal):
+        self.bet_id = bet_id
+        self.direction = direction
+        self.quantity = quantity
+        self.entry_price = entry_price
+        self.stop_loss = stop_loss
+        self.take_profit = take_profit
+
+    @classmethod
+    def from_row(cls, row) -> "LedgerEntry":
+        """ row is a `models.NettedBet`. """
+        return cls(row.bet_id, BetDirection(row.direction), row.quantity, row.entry_price, row.stop_loss,
+                   row.take_profit)
+
+    def columns(self) -> dict:
+        return dict(bet_id=self.bet_id, direction=self.direction.value, quantity=self.quantity,
+                    entry_price=self.entry_price, stop_loss=self.stop_loss, take_profit=self.take_profit)
+
+    @property
+    def signed_quantity(self) -> decimal.Decimal:
+        """ Position this bet contributes: long for UP, short for DOWN. """
+        return self.quantity if self.direction == BetDirection.UP else -self.quantity
+
+    def __repr__(self):
+        return (f"LedgerEntry({self.bet_id}, {self.direction.name}, qty={self.quantity}, "
+                f"entry={self.entry_price}, sl={self.stop_loss}, tp={self.take_profit})")
+
+
+def net_quantity(entries) -> decimal.Decimal:
+    return sum((entry.signed_quantity for entry in entries), decimal.Decimal(0))
+
+
+class NettingLedger:
+    def __init__(self):
+        self.entries: Dict[int, LedgerEntry] = {}
+
+    def add(self, entry: LedgerEntry):
+        logger.info("Netting %r", entry)
+        self.entries[entry.bet_id] = entry
+
+    def load(self, rows):
+        """ rows are `models.NettedBet`, see `models.get_netted_bets`. """
+        for row in rows:
+            entry = LedgerEntry.from_row(row)
+            self.entries[entry.bet_id] = entry
+        logger.info("Netting ledger: %d open bets, net %s", len(self.entries), net_quantity(self.entries.values()))
+
+    def remove(self, bet_ids) -> List[LedgerEntry]:
+        return [self.entries.pop(bet_id) for bet_id in bet_ids if bet_id in self.entries]
+
+    def crossed(self, price: decimal.Decimal) -> List[Tuple[LedgerEntry, bool]]:
+        """ Entries whose SL or TP `price` has reached, with True for a take profit. """
+        result = []
+        for entry in self.entries.values():
+            if entry.direction == BetDirection.UP:
+                if price >= entry.take_profit:
+                    result.append((entry, True))
+                elif price <= entry.stop_loss:
+                    result.append((entry, False))
+            else:
+                if price <= entry.take_profit:
+                    result.append((entry, True))
+                elif price >= entry.stop_loss:
+                    result.append((entry, False))
+        return result
@@ -0,0 +1,101 @@
+"""
+Token-bucket scheduler enforcing the `rate_limits` of an RPC endpoint set,
+or of a market's exchange requests.
+
+A spec such as "10000/300" allows 10000 requests per 300 seconds. Every spec
+of the list is a separate bucket, and a request needs a token from each.
+While the budget is tight, waiting requests are served by priority, so
+settlement transactions go ahead of log polling.
+"""
+
+import logging
+import threading
+import time
+from typing import List
+
+
+logger = logging.getLogger(__name__)
+
+SETTLEMENT = 0
+POLLING = 1
+PRIORITIES = (SETTLEMENT, POLLING)
+
+
+def parse_rate_limit(spec: str):
+    """ "10000/300" -> (10000, 300.0) """
+    requests, seconds = str(spec).split("/")
+    return int(requests), float(seconds)
+
+
+class TokenBucket:
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """ Seconds until a token is available. """
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    def __init__(self, specs: List[str], name: str = "RPC"):
+        self.name = name
+        self.buckets = [TokenBucket(*parse_rate_limit(spec)) for spec in specs]
+        self._cond = threading.Condition()
+        self._queued = {priority: 0 for priority in PRIORITIES}
+        self._granted = {priority: 0 for priority in PRIORITIES}
+        self._waited = {priority: 0.0 for priority in PRIORITIES}
+        self._max_wait = {priority: 0.0 for priority in PRIORITIES}
+
+    def acquire(self, priority: int = POLLING):
+        if not self.buckets:
+            return
+        started = time.monotonic()
+        with self._cond:
+            self._queued[priority] += 1
+            try:
+                while True:
+                    if any(self._queued[p] for p in PRIORITIES if p < priority):
+                        timeout = None  # Wait for the more important ones.
+                    else:
+                        timeout = self._take()
+                        if timeout == 0:
+                            break
+                    self._cond.wait(timeout)
+            finally:
+                self._queued[priority] -= 1
+                self._cond.notify_all()
+            waited = time.monotonic() - started
+            self._granted[priority] += 1
+            self._waited[priority] += waited
+            self._max_wait[priority] = max(self._max_wait[priority], waited)
+        if waited > 1:
+            logger.info("Waited %.1fs for the %s budget (priority %d)", waited, self.name, priority)
+
+    def _take(self) -> float:
+        now = time.monotonic()
+        for bucket in self.buckets:
+            bucket.refill(now)
+        delay = max(bucket.delay() for bucket in self.buckets)
+        if delay == 0:
+            for bucket in self.buckets:
+                bucket.tokens -= 1
+        return delay
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                priority: {
+                    "queued": self._queued[priority],
+                    "granted": self._granted[priority],
+                    "avg_wait": self._waited[priority] / self._granted[priority] if self._granted[priority] else 0.0,
+                    "max_wait": self._max_wait[priority],
+                }
+                for priority in PRIORITIES
+            }
@@ -1,18 +1,74 @@
+import asyncio
+from collections import OrderedDict
 import decimal
+import functools
 import logging
+import time
 
-from binance_wrappers import inverse_role, get_client_order_id, OrderRole
-from models import Bet, BetDirection, create_bet
+from binance_wrappers import inverse_role, get_client_order_id, parse_client_order_id, OrderRole, DEFAULT_SYMBOL
+from decoder import PlacedBet
+from executor import CHAIN, EXCHANGE, OrderGate
+from journal import JournaledBet, Step
+from metrics import BetTimer
+from models import Bet, BetDirection, UnitOfWork
+from netting import LedgerEntry, NettingLedger, net_quantity
+
+
+# The bet stage each completed order step stands for.
+ROLE_STAGES = {
+    OrderRole.INITIAL_MKT: "market_filled",
+    OrderRole.STOP_LOSS: "sl_placed",
+    OrderRole.TAKE_PROFIT: "tp_placed",
+}
+
+
+def bet_usd_amount(bet: Bet) -> decimal.Decimal:
+    return decimal.Decimal(int(bet.amount.hex(), 16)) / decimal.Decimal(10**18)
 
 
 class Reactor:
-    def __init__(self, config, contract_caller, create_order, check_open_orders, cancel_order):
+    # How many recently closed bets are remembered to skip duplicate closing.
+    CLOSED_HISTORY = 10000
+
+    def __init__(self, config, executor, contract_caller, create_order, check_open_orders, cancel_order,
+                 mark_prices=None, loop=None, create_net_order=None, create_market_order=None,
+                 get_mark_price=None, expiry=None, single_legged=None, journal=None,
+                 seen=None, unwind_bets=None):
         self.config = config
+        self.unwind_bets = unwind_bets
+        self.seen = seen
+        self.journal = journal
+        self.single_legged = single_legged
+        self.expiry = expiry
+        self.loop = loop
+        self.create_net_order = create_net_order
+        self.create_market_order = create_market_order
+        self.get_mark_price = get_mark_price
+        self.mark_prices = mark_prices
+        self.executor = executor
         self.contract_caller = contract_caller
         self.create_order = create_order
         self.check_open_orders = check_open_orders
         self.cancel_order = cancel_order
         self.binance_config = self.config["binance"]
+        self.symbol = self.binance_config.get("symbol", DEFAULT_SYMBOL)
+        max_quantity = self.binance_config.get("max_market_quantity")
+        self.max_market_quantity = decimal.Decimal(str(max_quantity)) if max_quantity is not None else None
+        self.order_gate = OrderGate()
+        # With the user data stream pushing fills, the full open order scan
+        # is only a periodic safety net. Without it, it runs every cycle.
+        self.pushed_updates = False
+        self.reconcile_seconds = self.binance_config.get("reconcile_seconds", 300)
+        self.last_reconciled = 0.0
+        self.closed = OrderedDict()
+        # Netting mode hedges a whole batch with one order, see netting.py.
+        self.netting = self.config["algo"].get("netting", False)
+        self.hedging = set()
+        self.ledger = NettingLedger()
+        self.settling = False
+        if self.netting and self.mark_prices is not None:
+            # Every streamed price is checked against the ledger's SL/TP.
+            self.mark_prices.subscribe(self.on_mark_price)
 
     def boundary_calculator(self, current_price, direction):
         safebelt_ratio = decimal.Decimal(self.config["algo"]["safebelt-trigger"]) / decimal.Decimal(100.0)
@@ -30,23 +86,246 @@ class Reactor:
         )
         return stop_loss_price, take_profit_price
 
-    def on_bet_created(self, bet: Bet):
-        base_order = self.create_order(self.binance_config, bet.id, BetDirection(bet.direction),
-                                       decimal.Decimal(int(bet.amount.hex(), 16)) / decimal.Decimal(10**18),
-                                       self.boundary_calculator)
-        self.contract_caller.on_bet_accepted(bet.id)
-        create_bet(bet)
+    async def on_bet_created(self, bet: PlacedBet, uow: UnitOfWork, journaled: JournaledBet = None,
+                             timer: BetTimer = None):
+        if bet.id in self.hedging:
+            logging.info("Bet %s is being hedged already", bet.id)
+            return
+        record, filled, placed = None, None, ()
+        if self.journal is not None:
+            # A bet delivered again after a failure continues where it stopped.
+            journaled = journaled or self.journal.in_flight.get(bet.id)
+            if journaled is None:
+                self.journal.begin(bet)
+            else:
+                filled, placed = journaled.fill, journaled.placed
+            record = self.journal.recorder(bet.id)
+        if timer is not None:
+            record = self.timed_recorder(timer, record)
+        self.hedging.add(bet.id)
+        try:
+            if len(placed) < 2:
+                async with self.order_gate.creating():
+                    await self.executor.run(EXCHANGE, self.create_order, self.binance_config, bet.id,
+                                            BetDirection(bet.direction), bet_usd_amount(bet), self.boundary_calculator,
+                                            record=record, filled=filled, placed=placed, timer=timer)
+            await self.on_bet_hedged(bet, uow, journaled, timer)
+        finally:
+            self.hedging.discard(bet.id)
+
+    @staticmethod
+    def timed_recorder(timer: BetTimer, record=None):
+        """ A `record(role, data)` marking the bet's stages, and passing them on to `record`. """
+        def timed_record(role, data):
+            if record is not None:
+                record(role, data)
+            timer.mark(ROLE_STAGES[role])
+
+        return timed_record
+
+    async def on_bet_hedged(self, bet: PlacedBet, uow: UnitOfWork, journaled: JournaledBet = None,
+                            timer: BetTimer = None):
+        if journaled is None or Step.ACCEPTED not in journaled.steps:
+            on_sent = functools.partial(timer.mark, "accepted_sent") if timer is not None else None
+            on_mined = None
+            if self.journal is not None and bet.id in self.journal.in_flight:
+                # The journal keeps the bet until betAccepted is on chain.
+                on_mined = functools.partial(self.journal.record, bet.id, Step.ACCEPTED)
+            await self.executor.run(CHAIN, self.contract_caller.on_bet_accepted, bet.id, on_sent, on_mined)
+        # Stored with the cycle's block checkpoint, see EventProvider.process_result.
+        uow.add_bet(bet.columns())
+
+    async def resume_journaled(self):
+        """ Finishes the bets a previous run left in flight, from their last journaled step. """
+        if self.journal is None or not self.journal.in_flight:
+            return
+        in_flight = list(self.journal.in_flight.values())
+        logging.info("Resuming %r", in_flight)
+        uow = UnitOfWork()
+        outcomes = await asyncio.gather(
+            *(self.on_bet_created(journaled.bet, uow, journaled) for journaled in in_flight), return_exceptions=True
+        )
+        for journaled, outcome in zip(in_flight, outcomes):
+            if isinstance(outcome, BaseException):
+                logging.error("Unable to resume bet %s: %r", journaled.bet.id, outcome)
+        await uow.commit()
+        self.on_stored(uow)
+
+    def on_stored(self, uow: UnitOfWork):
+        """ Keeps the journal, the known bets and the expiry schedule in step with a committed unit of work. """
+        if self.journal is not None:
+            self.journal.stored([row["id"] for row in uow.bets])
+        if self.seen is not None:
+            for row in uow.bets:
+                self.seen.add(row["id"])
+        if self.expiry is None:
+            return
+        for row in uow.bets:
+            self.expiry.add(row["id"], row["direction"], row["created"])
+        for bet_id in uow.outcomes:
+            self.expiry.discard(bet_id)
+
+    async def on_bets_netted(self, bets, uow: UnitOfWork, timer: BetTimer = None):
+        """
+        Hedges the net of `bets` with one market order and puts every bet
+        into the ledger, priced at the common entry. The entries are stored
+        with the bets.
+        """
+        directions = [BetDirection(bet.direction) for bet in bets]
+        legs = [(direction, bet_usd_amount(bet)) for direction, bet in zip(directions, bets)]
+        entry_price, quantities = await self.executor.run(
+            EXCHANGE, self.create_net_order, self.binance_config,
+            get_client_order_id(f"N{bets[0].id}", OrderRole.INITIAL_MKT), legs)
+        if timer is not None:
+            timer.mark("market_filled", len(bets))
+        entries = []
+        for bet, direction, quantity in zip(bets, directions, quantities):
+            stop_loss, take_profit = self.boundary_calculator(entry_price, direction)
+            entries.append(LedgerEntry(bet.id, direction, quantity, entry_price, stop_loss, take_profit))
+            self.ledger.add(entries[-1])
+        uow.add_netted([entry.columns() for entry in entries])
+
+    async def close_netted(self, bet_ids, uow: UnitOfWork):
+        """
+        Drops the bets from the ledger and closes their net with one order.
+        If the order fails, the entries are put back.
+        """
+        entries = self.ledger.remove(bet_ids)
+        net = net_quantity(entries)
+        if net != 0:
+            try:
+                await self.executor.run(
+                    EXCHANGE, self.create_market_order, self.binance_config,
+                    get_client_order_id(f"C{entries[0].bet_id}", OrderRole.INITIAL_MKT), -net)
+            except Exception:
+                for entry in entries:
+                    self.ledger.entries.setdefault(entry.bet_id, entry)
+                raise
+        uow.drop_netted([entry.bet_id for entry in entries])
+        return entries
+
+    async def unwind(self, bet_ids, uow: UnitOfWork):
+        """
+        Closes the positions of `bet_ids` together: one bulk cancel of their
+        legs and the fewest market orders for what is left, or one order for
+        their net in netting mode. Returns the ids of the closed bets.
+        """
+        if self.netting:
+            return [entry.bet_id for entry in await self.close_netted(bet_ids, uow)]
+        async with self.order_gate.creating():
+            await self.executor.run(EXCHANGE, self.unwind_bets, self.binance_config,
+                                    [str(bet_id) for bet_id in bet_ids], self.max_market_quantity)
+        return list(bet_ids)
+
+    async def on_bets_orphaned(self, bet_ids):
+        """
+        Unwinds the bets whose BetPlaced a reorganization dropped and the
+        new chain doesn't have, and forgets them: they don't exist on chain.
+        """
+        logging.warning("Unwinding %d bets orphaned by a reorganization: %r", len(bet_ids), bet_ids)
+        uow = UnitOfWork()
+        closed = []
+        try:
+            closed = await self.unwind(bet_ids, uow)
+            uow.forget_bets(closed)
+        finally:
+            await uow.commit()
+        for bet_id in closed:
+            if self.expiry is not None:
+                self.expiry.discard(bet_id)
+            if self.seen is not None:
+                # Hedged anew if it is mined again later on.
+                self.seen.discard(bet_id)
+
+    def on_mark_price(self, symbol, price):
+        """ Called on the mark price stream thread. """
+        if symbol == self.symbol:
+            self.loop.call_soon_threadsafe(self.check_crossed, price)
+
+    def check_crossed(self, price):
+        if self.settling or not self.ledger.crossed(price):
+            return
+        self.settling = True
+        self.loop.create_task(self.settle_streamed(price))
+
+    async def settle_streamed(self, price):
+        try:
+            await self.settle_netted(price)
+        except Exception:
+            logging.exception("Unable to settle netted bets at %s", price)
+        finally:
+            self.settling = False
+
+    async def settle_netted(self, price=None):
+        if price is None:
+            price = await self.executor.run(EXCHANGE, self.get_mark_price, self.binance_config)
+        crossed = self.ledger.crossed(price)
+        if not crossed:
+            return
+        uow = UnitOfWork()
+        try:
+            closed = {entry.bet_id for entry in await self.close_netted([entry.bet_id for entry, _ in crossed], uow)}
+        finally:
+            await uow.commit()
+        for entry, won in crossed:
+            if entry.bet_id not in closed:
+                continue  # Expired meanwhile.
+            logging.info("Netted bet %s %s at %s", entry.bet_id, "won" if won else "lost", price)
+            settle = self.contract_caller.mark_bet_as_won if won else self.contract_caller.mark_bet_as_lost
+            await self.executor.run(CHAIN, settle, entry.bet_id, 1, 1)
+
+    async def on_cycle_finished(self):
+        if self.mark_prices is not None:
+            logging.info("Mark price cache: %r", self.mark_prices.stats())
+        if self.seen is not None:
+            logging.info("Known bets: %r", self.seen.stats())
+        if self.netting:
+            await self.settle_netted()
+            return
+        if self.pushed_updates and time.monotonic() - self.last_reconciled < self.reconcile_seconds:
+            # Legs cancelled or expired by the exchange, or fills whose
+            # update was handled before the bet was fully placed.
+            if self.single_legged is not None:
+                async with self.order_gate.checking():
+                    orders_to_close = self.single_legged(self.binance_config)
+                await self.process_orders_to_close(orders_to_close)
+            return
+        async with self.order_gate.checking():
+            _, orders_to_close = await self.executor.run(EXCHANGE, self.check_open_orders, self.binance_config)
+        self.last_reconciled = time.monotonic()
+        await self.process_orders_to_close(orders_to_close)
+
+    def on_order_update(self, order: dict):
+        """ Called on the user data stream thread for every order update. """
+        if order.get("X") != "FILLED":
+            return
+        try:
+            base, role = parse_client_order_id(order["c"])
+        except ValueError:
+            return  # Not one of ours.
+        if role == OrderRole.INITIAL_MKT:
+            return
+        logging.info("Leg %s:%s was filled", base, role)
+        asyncio.run_coroutine_threadsafe(self.on_leg_filled(int(base), inverse_role(role)), self.loop)
 
-    def on_cycle_finished(self):
-        _, orders_to_close = self.check_open_orders(self.binance_config)
-        self.process_orders_to_close(orders_to_close)
+    async def on_leg_filled(self, base, remaining_role):
+        # Let a bet still placing its legs finish before closing it.
+        async with self.order_gate.checking():
+            pass
+        await self.process_orders_to_close([(base, remaining_role)])
 
-    def process_orders_to_close(self, orders_to_close):
+    async def process_orders_to_close(self, orders_to_close):
         for base, role in orders_to_close:
+            if base in self.closed:
+                continue
+            self.closed[base] = role
+            if len(self.closed) > self.CLOSED_HISTORY:
+                self.closed.popitem(last=False)
             logging.info("Leg %s:%s still remains open, closing it", base, role)
 
             try:
-                self.cancel_order(self.binance_config, get_client_order_id(base, role))
+                await self.executor.run(EXCHANGE, self.cancel_order, self.binance_config,
+                                        get_client_order_id(base, role))
             except Exception as e:
                 logging.exception("Unable to cancel order %s", e)
 
@@ -56,14 +335,14 @@ class Reactor:
                     base,
                     role,
                 )
-                self.contract_caller.mark_bet_as_won(int(base), 1, 1)
+                await self.executor.run(CHAIN, self.contract_caller.mark_bet_as_won, int(base), 1, 1)
             else:
                 logging.info(
                     "Stop loss order %s:%s was still on fly, so take profit was triggered.",
                     base,
                     role,
                 )
-                self.contract_caller.mark_bet_as_won(int(base), 1, 1)
+                await self.executor.run(CHAIN, self.contract_caller.mark_bet_as_won, int(base), 1, 1)
 
         # for base in open_orders:
         #         bet = get_bet(base)
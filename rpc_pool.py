@@ -0,0 +1,165 @@
+"""
+Shared pool of JSON-RPC endpoints with latency/health scoring and failover.
+"""
+
+import logging
+import threading
+import time
+from typing import List
+
+from web3 import Web3
+from web3.providers.base import BaseProvider
+
+import metrics
+from rate_limit import POLLING, RateLimiter
+
+
+logger = logging.getLogger(__name__)
+
+# Filters live on the node that created them, so these can't fail over.
+FILTER_METHODS = ("eth_getFilterChanges", "eth_getFilterLogs", "eth_uninstallFilter")
+
+
+class Endpoint:
+    def __init__(self, url: str):
+        self.url = url
+        self.provider = Web3.HTTPProvider(url)
+        self.latency = None  # EWMA, seconds
+        self.error_rate = 0.0  # EWMA of failed requests
+        self.failures = 0  # consecutive
+        self.down_until = 0.0
+        self.requests = 0
+
+    @property
+    def score(self) -> float:
+        """ Lower is better; untried endpoints go first so they get measured. """
+        if self.latency is None:
+            return 0.0
+        return self.latency * (1 + 10 * self.error_rate)
+
+    def __repr__(self):
+        latency = f"{self.latency * 1000:.1f}ms" if self.latency is not None else "-"
+        return f"Endpoint({self.url}, latency={latency}, errors={self.error_rate:.2f}, failures={self.failures})"
+
+
+class EndpointPool:
+    """
+    Sends each request to the best scored healthy endpoint. If the request
+    fails (transport errors only, an RPC error is a valid answer), it is
+    retried on the next one. After `max_failures` consecutive failures an
+    endpoint is benched for `cooldown` seconds. Then it gets one probe
+    request, and a success puts it back into rotation.
+
+    Every attempt is charged to the set's shared `rate_limits` budget.
+    """
+
+    def __init__(self, urls: List[str], rate_limits: List[str] = (), max_attempts: int = 3,
+                 max_failures: int = 3, cooldown: float = 30.0, alpha: float = 0.2):
+        if not urls:
+            raise RuntimeError("No active entrypoints")
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.limiter = RateLimiter(rate_limits)
+        self.max_attempts = max_attempts
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self._filters = {}
+        self._lock = threading.Lock()
+
+    def ranked(self) -> List[Endpoint]:
+        now = time.monotonic()
+        with self._lock:
+            healthy = [e for e in self.endpoints if e.down_until <= now]
+            benched = [e for e in self.endpoints if e.down_until > now]
+        healthy.sort(key=lambda e: e.score)
+        # Everything benched is still better than not trying at all.
+        benched.sort(key=lambda e: e.down_until)
+        return healthy + benched
+
+    def record(self, endpoint: Endpoint, elapsed: float, ok: bool):
+        with self._lock:
+            endpoint.requests += 1
+            endpoint.error_rate += self.alpha * ((0.0 if ok else 1.0) - endpoint.error_rate)
+            if ok:
+                endpoint.latency = elapsed if endpoint.latency is None else (
+                    endpoint.latency + self.alpha * (elapsed - endpoint.latency))
+                if endpoint.failures >= self.max_failures:
+                    logger.info("Endpoint %s is back", endpoint.url)
+                endpoint.failures = 0
+                endpoint.down_until = 0.0
+            else:
+                endpoint.failures += 1
+                if endpoint.failures >= self.max_failures:
+                    logger.warning("Benching endpoint %r for %ss", endpoint, self.cooldown)
+                    endpoint.down_until = time.monotonic() + self.cooldown
+
+    def send(self, endpoint: Endpoint, method, params):
+        started = time.monotonic()
+        metrics.counter("rpc_requests_total", "JSON-RPC requests sent", method=method).inc()
+        try:
+            response = endpoint.provider.make_request(method, params)
+        except Exception:
+            self.record(endpoint, time.monotonic() - started, ok=False)
+            metrics.counter("rpc_errors_total", "Failed or error JSON-RPC requests", method=method).inc()
+            raise
+        elapsed = time.monotonic() - started
+        self.record(endpoint, elapsed, ok=True)
+        metrics.histogram("rpc_request_seconds", "JSON-RPC request latency", method=method).observe(elapsed)
+        if "error" in response:
+            metrics.counter("rpc_errors_total", "Failed or error JSON-RPC requests", method=method).inc()
+        return response
+
+    def make_request(self, method, params, priority: int = POLLING, endpoint: Endpoint = None):
+        """ `endpoint` pins the request to one node, without failover. """
+        if endpoint is None and method in FILTER_METHODS and params and params[0] in self._filters:
+            endpoint = self._filters[params[0]]
+        if endpoint is not None:
+            self.limiter.acquire(priority)
+            return self.send(endpoint, method, params)
+
+        error = None
+        for endpoint in self.ranked()[:self.max_attempts]:
+            self.limiter.acquire(priority)
+            try:
+                response = self.send(endpoint, method, params)
+            except Exception as e:
+                logger.warning("%s failed on %s: %s", method, endpoint.url, e)
+                error = e
+                continue
+            if method == "eth_newFilter" and "result" in response:
+                self._filters[response["result"]] = endpoint
+            return response
+        raise error
+
+    def stats(self):
+        return {"endpoints": list(self.endpoints), "budget": self.limiter.stats()}
+
+
+class PooledProvider(BaseProvider):
+    """
+    web3 provider backed by an `EndpointPool`, charging `priority`. With
+    `endpoint` every request goes to that node, for reads that must all
+    see the same chain.
+    """
+
+    def __init__(self, pool: EndpointPool, priority: int = POLLING, endpoint: Endpoint = None):
+        super().__init__()
+        self.pool = pool
+        self.priority = priority
+        self.endpoint = endpoint
+
+    def make_request(self, method, params):
+        return self.pool.make_request(method, params, self.priority, self.endpoint)
+
+    def is_connected(self) -> bool:
+        for endpoint in self.pool.ranked():
+            try:
+                if endpoint.provider.isConnected():
+                    logger.info("Found active entry point %s", endpoint.url)
+                    return True
+            except Exception:
+                logger.info("Unable to connect to entrypoint %s", endpoint.url)
+        return False
+
+    # web3 releases before 5.28 call it by this name.
+    isConnected = is_connected
@@ -0,0 +1,127 @@
+"""
+One pipeline per market, each in its own process.
+
+A market is a bet contract and the futures symbol its bets are hedged on.
+The config's own `incoming.contract` and `binance.symbol` make the first
+shard, run by the main process. Every entry of `markets` overrides sections
+of the config for another shard, run by a worker process: its own executor
+lanes, order registry, open order reconciliation, journal and database.
+Shards share nothing but the exchange account and the RPC endpoints, so a
+new market adds a pipeline instead of lengthening the existing queue.
+
+The `rate_limits` of the account and of an endpoint set are their whole
+budget: it is split evenly between the shards sharing them.
+"""
+
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+from typing import List
+
+from binance_wrappers import DEFAULT_SYMBOL
+from rate_limit import parse_rate_limit
+
+logger = logging.getLogger(__name__)
+
+# What two shards must never share: bet ids, nonces and the block cursor are per shard.
+DISTINCT_KEYS = (
+    ("binance", "symbol"),
+    ("incoming", "contract"),
+    ("rewards", "sender_address"),
+    ("db", "conn"),
+    ("db", "journal"),
+    ("metrics", "port"),
+)
+
+# Budgets the shards share: section -> the keys telling whose budget it is.
+SHARED_BUDGETS = (
+    ("binance", ("URL", "API_Key")),
+    ("incoming", ("rpc",)),
+)
+
+
+def _share(spec: str, shards: int) -> str:
+    """ "600/60" split between 4 shards -> "150/60" """
+    requests, seconds = parse_rate_limit(spec)
+    return f"{max(1, requests // shards)}/{seconds:g}"
+
+
+def _split_budgets(configs: List[dict]):
+    for section, owner_keys in SHARED_BUDGETS:
+        owners = {}
+        for shard in configs:
+            owner = tuple(str(shard.get(section, {}).get(key)) for key in owner_keys)
+            owners.setdefault(owner, []).append(shard)
+        for shards in owners.values():
+            budgets = {tuple(shard[section].get("rate_limits") or ()) for shard in shards}
+            if len(budgets) > 1:
+                raise ValueError(f"markets: shards sharing {section} endpoints must not override its rate_limits, "
+                                 f"the budget is split between them, got {sorted(budgets)}")
+            budget = budgets.pop()
+            if len(shards) == 1 or not budget:
+                continue
+            for shard in shards:
+                shard[section] = {**shard[section], "rate_limits": [_share(spec, len(shards)) for spec in budget]}
+            logger.info("Each of %d shards gets %r of the %s budget %r",
+                        len(shards), shards[0][section]["rate_limits"], section, list(budget))
+
+
+def shard_configs(config) -> List[dict]:
+    """ The main shard's config, then one per `markets` entry. """
+    base = {section: value for section, value in config.items() if section != "markets"}
+    configs = [base]
+    for market in config.get("markets") or ():
+        shard = dict(base)
+        for section, overrides in market.items():
+            shard[section] = {**base.get(section, {}), **overrides}
+        configs.append(shard)
+    for section, key in DISTINCT_KEYS:
+        values = [shard.get(section, {}).get(key) for shard in configs]
+        values = [value for value in values if value is not None]
+        if len(values) != len(set(values)):
+            raise ValueError(f"markets: {section}.{key} must differ between the shards, got {values}")
+    _split_budgets(configs)
+    return configs
+
+
+def _run_shard(run, config):
+    symbol = config["binance"].get("symbol", DEFAULT_SYMBOL)
+    logging.basicConfig(
+        level=logging.DEBUG, stream=sys.stdout, format=f"%(levelname)s:{symbol}:%(name)s:%(message)s"
+    )
+    try:
+        run(config)
+    except KeyboardInterrupt:
+        pass
+
+
+def start_shards(configs: List[dict], run) -> List[multiprocessing.Process]:
+    """
+    Starts `run(shard config)` in a worker process for every one of
+    `shard_configs` but the first, the main shard the caller runs itself.
+    """
+    # Spawned, not forked: a shard starts with no threads or connections of ours.
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    for shard in configs[1:]:
+        symbol = shard["binance"].get("symbol", DEFAULT_SYMBOL)
+        worker = context.Process(target=_run_shard, args=(run, shard), name=f"shard-{symbol}")
+        worker.start()
+        logger.info("Started the %s shard, pid %d", symbol, worker.pid)
+        workers.append(worker)
+    return workers
+
+
+def stop_shards(workers: List[multiprocessing.Process], timeout: float = 30):
+    """ Interrupts the workers like Ctrl+C does, so they shut down cleanly. """
+    for worker in workers:
+        if worker.is_alive():
+            os.kill(worker.pid, signal.SIGINT)
+    for worker in workers:
+        worker.join(timeout)
+        if worker.is_alive():
+            logger.warning("Shard %s did not stop, terminating it", worker.name)
+            worker.terminate()
+            worker.join()
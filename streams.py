@@ -0,0 +1,169 @@
+"""
+Background consumers of the Binance futures WebSocket streams.
+"""
+
+import decimal
+import json
+import logging
+import threading
+import time
+
+import websocket
+
+
+logger = logging.getLogger(__name__)
+
+
+class StreamClient:
+    """
+    Keeps a WebSocket connection open on a daemon thread, reconnecting when
+    it drops, and hands every decoded message to `on_payload`.
+    """
+
+    RECONNECT_DELAY = 1.0
+
+    def __init__(self, url: str):
+        self.url = url
+        self._app = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._app is not None:
+            self._app.close()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def stream_url(self) -> str:
+        return self.url
+
+    def on_payload(self, payload):
+        raise NotImplementedError
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                url = self.stream_url()
+                logger.info("Connecting to stream %s", url)
+                self._app = websocket.WebSocketApp(
+                    url, on_message=self._on_message, on_error=self._on_error
+                )
+                self._app.run_forever(ping_interval=60, ping_timeout=10)
+            except Exception:
+                logger.exception("Stream %s failed", self.url)
+            if not self._stopped.is_set():
+                logger.warning("Stream %s dropped, reconnecting", self.url)
+                self._stopped.wait(self.RECONNECT_DELAY)
+
+    def _on_message(self, app, message):
+        try:
+            self.on_payload(json.loads(message))
+        except Exception:
+            logger.exception("Unable to handle stream message %r", message)
+
+    def _on_error(self, app, error):
+        logger.warning("Stream %s error: %s", self.url, error)
+
+
+class MarkPriceCache(StreamClient):
+    """
+    Latest mark price per symbol, fed by the `<symbol>@markPrice@1s` streams.
+
+    Prices older than `max_age` seconds are not trusted: `get` falls back to
+    `fallback(symbol)` (a REST call) and counts a miss, so `stats` shows how
+    often sizing had to leave the cache. Every streamed price is also passed
+    to the `subscribe`d callbacks, on the stream thread.
+    """
+
+    def __init__(self, base_url: str, symbols, fallback, max_age: float = 3.0):
+        streams = "/".join(f"{symbol.lower()}@markPrice@1s" for symbol in symbols)
+        super().__init__(f"{base_url}/stream?streams={streams}")
+        self.fallback = fallback
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._prices = {}
+        self._listeners = []
+
+    def subscribe(self, on_price):
+        """ `on_price(symbol, price)` for every streamed price. """
+        self._listeners.append(on_price)
+
+    def on_payload(self, payload):
+        data = payload.get("data", payload)
+        if data.get("e") == "markPriceUpdate":
+            price = decimal.Decimal(data["p"])
+            self._prices[data["s"]] = (price, time.monotonic())
+            for on_price in self._listeners:
+                on_price(data["s"], price)
+
+    def age(self, symbol: str) -> float:
+        cached = self._prices.get(symbol)
+        return time.monotonic() - cached[1] if cached is not None else float("inf")
+
+    def get(self, symbol: str) -> decimal.Decimal:
+        cached = self._prices.get(symbol)
+        if cached is not None and time.monotonic() - cached[1] <= self.max_age:
+            self.hits += 1
+            return cached[0]
+        self.misses += 1
+        logger.info("Mark price of %s is %.1fs old, asking REST", symbol, self.age(symbol))
+        price = decimal.Decimal(str(self.fallback(symbol)))
+        self._prices[symbol] = (price, time.monotonic())
+        return price
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else None,
+            "age": {symbol: round(self.age(symbol), 3) for symbol in self._prices},
+        }
+
+
+class UserDataStream(StreamClient):
+    """
+    Account updates from the user data stream.
+
+    A listen key is requested on every (re)connect and kept alive every
+    `keepalive` seconds. Order updates (the `o` part of ORDER_TRADE_UPDATE)
+    are passed to `on_order_update` on the stream thread.
+    """
+
+    def __init__(self, base_url: str, start_listen_key, keep_listen_key, on_order_update,
+                 keepalive: float = 30 * 60):
+        super().__init__(base_url)
+        self.start_listen_key = start_listen_key
+        self.keep_listen_key = keep_listen_key
+        self.on_order_update = on_order_update
+        self.keepalive = keepalive
+        self._keeper = None
+
+    def start(self):
+        super().start()
+        self._keeper = threading.Thread(target=self._keep_alive, name="ListenKeyKeeper", daemon=True)
+        self._keeper.start()
+
+    def stream_url(self) -> str:
+        return f"{self.url}/ws/{self.start_listen_key()}"
+
+    def on_payload(self, payload):
+        event = payload.get("e")
+        if event == "ORDER_TRADE_UPDATE":
+            self.on_order_update(payload["o"])
+        elif event == "listenKeyExpired":
+            logger.warning("Listen key expired, reconnecting")
+            self._app.close()
+
+    def _keep_alive(self):
+        while not self._stopped.wait(self.keepalive):
+            try:
+                self.keep_listen_key()
+            except Exception:
+                logger.exception("Unable to keep the listen key alive")
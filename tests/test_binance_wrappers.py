@@ -0,0 +1,51 @@
+import decimal
+
+import pytest
+
+import binance_wrappers
+from benchmarks.fakes import FakeExchange
+from binance_wrappers import OrderRole, create_order, get_client_order_id, unwind_bets
+from models import BetDirection
+
+
+def boundaries(price, direction):
+    """ Stop loss and take profit 10% away from the entry. """
+    below, above = price * decimal.Decimal("0.9"), price * decimal.Decimal("1.1")
+    return (below, above) if direction == BetDirection.UP else (above, below)
+
+
+@pytest.fixture
+def exchange():
+    fake = FakeExchange().start()
+    yield fake
+    binance_wrappers.shutdown_clients()
+    fake.stop()
+
+
+@pytest.fixture
+def config(exchange):
+    return {"URL": exchange.url, "API_Key": "test", "Secret_Key": "test"}
+
+
+def test_unwind_skips_a_bet_without_legs(exchange, config):
+    create_order(config, "11", BetDirection.UP, decimal.Decimal(1), boundaries)
+    hedged = exchange.orders[get_client_order_id("11", OrderRole.STOP_LOSS)]
+
+    net = unwind_bets(config, ["11", "12"])
+
+    # Bet 12 is unknown to the exchange, bet 11 is still closed.
+    assert net == decimal.Decimal(hedged["origQty"])
+    assert exchange.open == {}
+    close = exchange.orders[get_client_order_id("X11-0", OrderRole.INITIAL_MKT)]
+    assert close["side"] == "SELL" and close["origQty"] == hedged["origQty"]
+
+
+def test_unwind_closes_a_bet_cancelled_before(exchange, config):
+    create_order(config, "11", BetDirection.DOWN, decimal.Decimal(1), boundaries)
+    for role in (OrderRole.STOP_LOSS, OrderRole.TAKE_PROFIT):
+        exchange.cancel(get_client_order_id("11", role))
+
+    net = unwind_bets(config, ["11"])
+
+    assert net == -decimal.Decimal(exchange.orders["111"]["origQty"])
+    assert exchange.orders[get_client_order_id("X11-0", OrderRole.INITIAL_MKT)]["side"] == "BUY"
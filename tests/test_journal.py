@@ -0,0 +1,198 @@
+import asyncio
+import datetime
+import decimal
+
+import pytest
+from sqlalchemy import create_engine
+
+import binance_wrappers
+from benchmarks.fakes import FakeExchange
+from binance_wrappers import OrderRole, create_order
+from decoder import PlacedBet
+from executor import Executor
+from journal import Journal, Step
+from models import Base, BetDirection, close_db, get_bet, init_db
+from reactor import Reactor
+
+
+FILL = {"symbol": "BTCUSDT", "clientOrderId": "71", "avgPrice": "40000.0", "executedQty": "0.500"}
+
+
+def placed_bet(bet_id: int = 7) -> PlacedBet:
+    return PlacedBet(bet_id, bytes(32), bytes(20), (10**18).to_bytes(32, "big"),
+                     datetime.datetime(2026, 10, 1, 12, 0), 0)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "journal.sqlite")
+
+
+def reopen(journal: Journal) -> Journal:
+    """ A new run on the same file, as after a crash. """
+    journal.close()
+    return Journal(journal.path)
+
+
+def hedge(journal: Journal, bet: PlacedBet):
+    journal.begin(bet)
+    journal.record(bet.id, Step.MARKET_FILLED, FILL)
+    journal.record(bet.id, Step.SL_PLACED)
+    journal.record(bet.id, Step.TP_PLACED)
+
+
+def test_reload_resumes_from_the_last_step(path):
+    journal = Journal(path)
+    bet = placed_bet()
+    journal.begin(bet)
+    journal.record(bet.id, Step.MARKET_FILLED, FILL)
+    journal.record(bet.id, Step.SL_PLACED)
+
+    journal = reopen(journal)
+
+    resumed = journal.in_flight[bet.id]
+    assert resumed.bet.columns() == bet.columns()
+    assert resumed.fill == FILL
+    assert resumed.placed == (OrderRole.STOP_LOSS,)
+    assert not resumed.committed
+
+
+def test_accepted_then_stored_is_done(path):
+    journal = Journal(path)
+    bet = placed_bet()
+    hedge(journal, bet)
+    journal.record(bet.id, Step.ACCEPTED)
+    assert bet.id in journal.in_flight
+
+    journal.stored([bet.id])
+
+    assert bet.id not in journal.in_flight
+    assert reopen(journal).in_flight == {}
+
+
+def test_stored_then_accepted_is_done(path):
+    journal = Journal(path)
+    bet = placed_bet()
+    hedge(journal, bet)
+    journal.stored([bet.id])
+    # Committed, but betAccepted is not mined yet.
+    assert journal.in_flight[bet.id].committed
+
+    journal.record(bet.id, Step.ACCEPTED)
+
+    assert bet.id not in journal.in_flight
+    assert reopen(journal).in_flight == {}
+
+
+def test_commit_of_a_previous_run_is_not_trusted(path):
+    journal = Journal(path)
+    bet = placed_bet()
+    hedge(journal, bet)
+    journal.stored([bet.id])
+
+    # The commit may not have made it, the bet is delivered again.
+    journal = reopen(journal)
+    assert not journal.in_flight[bet.id].committed
+    journal.record(bet.id, Step.ACCEPTED)
+    assert bet.id in journal.in_flight
+
+
+class AcceptingCaller:
+    """ Mines betAccepted right away, or with `mine` later on. """
+
+    def __init__(self, mined_at_once: bool):
+        self.mined_at_once = mined_at_once
+        self.accepted = []
+        self.pending = []
+
+    def on_bet_accepted(self, bet_id, on_sent=None, on_mined=None):
+        self.accepted.append(bet_id)
+        if self.mined_at_once:
+            on_mined()
+        else:
+            self.pending.append(on_mined)
+
+    def mine(self):
+        for on_mined in self.pending:
+            on_mined()
+
+
+@pytest.fixture
+def exchange():
+    fake = FakeExchange().start()
+    yield fake
+    binance_wrappers.shutdown_clients()
+    fake.stop()
+
+
+@pytest.fixture
+def db(tmp_path):
+    conn = f"sqlite:///{tmp_path / 'bets.sqlite'}"
+    Base.metadata.create_all(create_engine(conn))
+    return conn
+
+
+class Crash(Exception):
+    pass
+
+
+def crash_after(journal: Journal, bet_id: int, last: OrderRole):
+    """ A recorder that stops create_order once `last` is journaled. """
+    record = journal.recorder(bet_id)
+
+    def crashing(role, data):
+        record(role, data)
+        if role == last:
+            raise Crash
+
+    return crashing
+
+
+def reactor_boundaries(config):
+    return Reactor(config, None, None, None, None, None).boundary_calculator
+
+
+@pytest.mark.parametrize("mined_at_once", [True, False])
+def test_resume_places_only_the_missing_legs(path, exchange, db, mined_at_once):
+    config = {
+        "binance": {"URL": exchange.url, "API_Key": "test", "Secret_Key": "test"},
+        "algo": {"safebelt-trigger": 1.5, "win-trigger": 2.5},
+    }
+    bet = placed_bet()
+    journal = Journal(path)
+    journal.begin(bet)
+    with pytest.raises(Crash):
+        create_order(config["binance"], bet.id, BetDirection.UP, decimal.Decimal(1), reactor_boundaries(config),
+                     record=crash_after(journal, bet.id, OrderRole.STOP_LOSS))
+    orders = dict(exchange.requests)
+    assert "72" not in exchange.orders
+
+    journal = reopen(journal)
+    caller = AcceptingCaller(mined_at_once)
+    executor = Executor()
+    reactor = Reactor(config, executor, caller, create_order, None, None, journal=journal)
+
+    async def resume():
+        init_db({"conn": db})
+        try:
+            await reactor.resume_journaled()
+            return await get_bet(bet.id)
+        finally:
+            await close_db()
+
+    try:
+        stored = asyncio.run(resume())
+    finally:
+        executor.shutdown()
+
+    # Only the take profit leg went out, the market order was not repeated.
+    assert exchange.requests["POST /fapi/v1/order"] == orders["POST /fapi/v1/order"] + 1
+    assert exchange.orders["72"]["type"] == "TAKE_PROFIT_MARKET"
+    assert caller.accepted == [bet.id]
+    assert stored is not None
+    if not mined_at_once:
+        # Committed, kept until betAccepted is mined.
+        assert journal.in_flight[bet.id].committed
+        caller.mine()
+    assert journal.in_flight == {}
+    assert reopen(journal).in_flight == {}
@@ -0,0 +1,143 @@
+import asyncio
+import datetime
+
+import pytest
+from sqlalchemy import create_engine
+
+from models import (
+    Base,
+    EventKind,
+    Outcome,
+    UnitOfWork,
+    close_db,
+    get_bet,
+    get_last_processed_block,
+    get_open_bets,
+    get_placed_bet_ids,
+    get_settled_on_chain,
+    init_db,
+    rewind_after_reorg,
+)
+
+
+CREATED = datetime.datetime(2026, 10, 1, 12, 0)
+
+
+@pytest.fixture
+def db(tmp_path):
+    """ Runs a coroutine function against a fresh SQLite database. """
+    conn = f"sqlite:///{tmp_path / 'bets.sqlite'}"
+    Base.metadata.create_all(create_engine(conn))
+
+    def run(scenario):
+        async def main():
+            init_db({"conn": conn})
+            try:
+                return await scenario()
+            finally:
+                await close_db()
+
+        return asyncio.run(main())
+
+    return run
+
+
+def bet(bet_id: int, direction: int = 0, minutes: int = 0) -> dict:
+    return dict(id=bet_id, tx=bytes(32), sender=bytes(20), amount=bytes(32),
+                created=CREATED + datetime.timedelta(minutes=minutes), direction=direction)
+
+
+def event(block: int, bet_id: int, kind: EventKind, log_index: int = 0) -> dict:
+    return dict(block=block, log_index=log_index, bet_id=bet_id, kind=kind.value, tx=bytes(32))
+
+
+async def commit(bets=(), events=(), block=None, outcomes=()):
+    uow = UnitOfWork()
+    for row in bets:
+        uow.add_bet(row)
+    uow.index_events(list(events))
+    if block is not None:
+        uow.checkpoint(block)
+    for bet_id, outcome in outcomes:
+        uow.set_outcome(bet_id, outcome)
+    await uow.commit()
+
+
+def test_commit_ignores_rows_stored_already(db):
+    async def scenario():
+        await commit([bet(1, direction=0)], [event(10, 1, EventKind.PLACED)], block=10)
+        # Re-delivered after a crash, together with a new bet.
+        await commit([bet(1, direction=1), bet(2)], [event(10, 1, EventKind.PLACED), event(11, 2, EventKind.PLACED)],
+                     block=11)
+        return await get_bet(1), await get_bet(2), await get_placed_bet_ids([1, 2])
+
+    first, second, placed = db(scenario)
+    assert first.direction == 0
+    assert second is not None
+    assert placed == {1, 2}
+
+
+def test_checkpoint_never_moves_back(db):
+    async def scenario():
+        blocks = [await get_last_processed_block(5)]
+        for block in (100, 90, 120):
+            await commit(block=block)
+            blocks.append(await get_last_processed_block(5))
+        return blocks
+
+    assert db(scenario) == [5, 100, 100, 120]
+
+
+def test_commit_sets_outcomes(db):
+    async def scenario():
+        await commit([bet(1, minutes=2), bet(2, minutes=1), bet(3), bet(4, minutes=3)])
+        await commit(outcomes=[(1, Outcome.WIN), (2, Outcome.TIMEOUT), (4, Outcome.TIMEOUT)])
+        return [(await get_bet(bet_id)).outcome for bet_id in (1, 2, 3, 4)], await get_open_bets()
+
+    outcomes, still_open = db(scenario)
+    assert outcomes == [Outcome.WIN.value, Outcome.TIMEOUT.value, None, Outcome.TIMEOUT.value]
+    assert [row.id for row in still_open] == [3]
+
+
+def test_empty_unit_of_work_commits_nothing(db):
+    async def scenario():
+        await UnitOfWork().commit()
+        return await get_last_processed_block(7)
+
+    assert db(scenario) == 7
+
+
+def test_rewind_after_reorg(db):
+    async def scenario():
+        await commit(
+            [bet(1), bet(2), bet(3)],
+            [event(10, 1, EventKind.PLACED), event(11, 2, EventKind.PLACED), event(12, 3, EventKind.PLACED),
+             event(12, 1, EventKind.ACCEPTED, log_index=1)],
+            block=12,
+        )
+        orphaned = await rewind_after_reorg(10)
+        return (orphaned, await get_last_processed_block(0), await get_placed_bet_ids([1, 2, 3]),
+                await get_settled_on_chain([1]), await get_bet(2))
+
+    orphaned, block, placed, settled, kept = db(scenario)
+    assert sorted(orphaned) == [2, 3]
+    assert block == 10
+    assert placed == {1}
+    assert settled == {}
+    # The rows stay, they are unwound and forgotten by the reactor.
+    assert kept is not None
+
+
+def test_get_settled_on_chain(db):
+    async def scenario():
+        await commit(events=[
+            event(10, 1, EventKind.PLACED), event(11, 1, EventKind.WON),
+            event(10, 2, EventKind.PLACED, log_index=1), event(11, 2, EventKind.LOST, log_index=1),
+            event(10, 3, EventKind.PLACED, log_index=2), event(11, 3, EventKind.CANCELED, log_index=2),
+            event(10, 4, EventKind.PLACED, log_index=3), event(11, 4, EventKind.ACCEPTED, log_index=3),
+        ])
+        return await get_settled_on_chain([1, 2, 3, 4, 5]), await get_settled_on_chain([])
+
+    settled, none = db(scenario)
+    assert settled == {1: EventKind.WON, 2: EventKind.LOST, 3: EventKind.CANCELED}
+    assert none == {}
@@ -0,0 +1,103 @@
+import time
+
+import pytest
+
+from benchmarks.fakes import FakeChain
+from rpc_pool import EndpointPool
+
+
+CONTRACT = "0x295B855E8AD2316762Ea8Db12770e9A821f13DE6"
+
+
+@pytest.fixture
+def chains():
+    started = []
+
+    def start(latency: float = 0.0, port: int = 0) -> FakeChain:
+        chain = FakeChain(CONTRACT, latency=latency, port=port).start()
+        started.append(chain)
+        return chain
+
+    yield start
+    for chain in started:
+        try:
+            chain.stop()
+        except OSError:
+            pass
+
+
+def block_number(pool: EndpointPool) -> int:
+    response = pool.make_request("eth_blockNumber", [])
+    return int(response["result"], 16)
+
+
+def test_faster_endpoint_is_ranked_first(chains):
+    slow, fast = chains(latency=0.05), chains()
+    pool = EndpointPool([slow.url, fast.url])
+
+    for _ in range(20):
+        block_number(pool)
+
+    assert [endpoint.url for endpoint in pool.ranked()] == [fast.url, slow.url]
+    # Both were measured once, then the fast one took everything.
+    assert fast.requests["eth_blockNumber"] == 19
+    assert slow.requests["eth_blockNumber"] == 1
+
+
+def test_fails_over_to_the_next_endpoint(chains):
+    down, up = chains(), chains()
+    pool = EndpointPool([down.url, up.url])
+    down.stop()
+
+    assert block_number(pool) >= 0
+    first, second = pool.endpoints
+    assert first.failures == 1 and first.error_rate > 0
+    assert second.failures == 0 and up.requests["eth_blockNumber"] == 1
+
+
+def test_failing_endpoint_is_benched_for_cooldown(chains):
+    down, up = chains(), chains()
+    pool = EndpointPool([down.url, up.url], max_failures=2, cooldown=30)
+    benched = pool.endpoints[0]
+    down.stop()
+
+    for _ in range(2):
+        block_number(pool)
+    assert benched.down_until > time.monotonic() + 25
+    assert pool.ranked()[-1] is benched
+
+    for _ in range(5):
+        block_number(pool)
+    # Not tried again while benched.
+    assert benched.failures == 2
+    assert up.requests["eth_blockNumber"] == 7
+
+
+def test_benched_endpoint_recovers_after_cooldown(chains):
+    flaky, steady = chains(), chains(latency=0.02)
+    port = int(flaky.url.rsplit(":", 1)[1])
+    pool = EndpointPool([flaky.url, steady.url], max_failures=1, cooldown=0.3)
+    recovering = pool.endpoints[0]
+    flaky.stop()
+    block_number(pool)
+    assert recovering.down_until > time.monotonic()
+
+    back = chains(port=port)
+    time.sleep(0.3)
+    # Out of the bench, its score wins the probe, and success clears it.
+    assert pool.ranked()[0] is recovering
+    block_number(pool)
+    assert back.requests["eth_blockNumber"] == 1
+    assert recovering.failures == 0 and recovering.down_until == 0.0
+
+
+def test_pinned_requests_stay_on_their_endpoint(chains):
+    fast, slow = chains(), chains(latency=0.02)
+    pool = EndpointPool([fast.url, slow.url])
+    pinned = pool.endpoints[1]
+
+    for _ in range(3):
+        pool.make_request("eth_blockNumber", [], endpoint=pinned)
+
+    assert slow.requests["eth_blockNumber"] == 3
+    assert fast.requests["eth_blockNumber"] == 0
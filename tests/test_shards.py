@@ -0,0 +1,18 @@
+from shards import shard_configs
+
+
+def test_main_shard_gets_its_share_of_the_budgets():
+    config = {
+        "binance": {"URL": "https://fapi", "API_Key": "key", "symbol": "BTCUSDT", "rate_limits": ["1200/60"]},
+        "incoming": {"rpc": ["https://rpc"], "contract": "0xa", "rate_limits": ["100/1"]},
+        "markets": [{"binance": {"symbol": "ETHUSDT"}, "incoming": {"contract": "0xb"}}],
+    }
+
+    main, market = shard_configs(config)
+
+    for shard in (main, market):
+        assert shard["binance"]["rate_limits"] == ["600/60"]
+        assert shard["incoming"]["rate_limits"] == ["50/1"]
+    assert "markets" not in main
+    # The caller's config is left as it was.
+    assert config["binance"]["rate_limits"] == ["1200/60"]
@@ -0,0 +1,71 @@
+import decimal
+import time
+
+import pytest
+
+from benchmarks.fakes import FakeMarkPriceStream
+from streams import MarkPriceCache
+
+
+def wait_until(predicate, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def stream():
+    fake = FakeMarkPriceStream(price=40000.5, interval=0.05).start()
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def fallback_calls():
+    return []
+
+
+@pytest.fixture
+def cache(stream, fallback_calls):
+    def fallback(symbol):
+        fallback_calls.append(symbol)
+        return "39000.1"
+
+    cache = MarkPriceCache(stream.url, ("BTCUSDT",), fallback, max_age=0.5)
+    cache.RECONNECT_DELAY = 0.05
+    cache.start()
+    yield cache
+    cache.stop()
+
+
+def test_streamed_price_is_a_hit(stream, cache, fallback_calls):
+    wait_until(lambda: cache.age("BTCUSDT") < cache.max_age)
+
+    assert cache.get("BTCUSDT") == decimal.Decimal("40000.5")
+    assert cache.stats()["hits"] == 1
+    assert fallback_calls == []
+    assert stream.paths == ["/stream?streams=btcusdt@markPrice@1s"]
+
+
+def test_stale_price_falls_back_to_rest(stream, cache, fallback_calls):
+    wait_until(lambda: cache.age("BTCUSDT") < cache.max_age)
+    stream.pushing = False
+    wait_until(lambda: cache.age("BTCUSDT") > cache.max_age)
+
+    assert cache.get("BTCUSDT") == decimal.Decimal("39000.1")
+    assert fallback_calls == ["BTCUSDT"]
+    assert cache.stats()["misses"] == 1
+    # The REST price is cached like a streamed one.
+    assert cache.get("BTCUSDT") == decimal.Decimal("39000.1")
+    assert cache.stats()["hits"] == 1
+
+
+def test_reconnects_after_the_server_drops(stream, cache, fallback_calls):
+    wait_until(lambda: cache.age("BTCUSDT") < cache.max_age)
+    stream.drop()
+    stream.price = 41000.0
+    wait_until(lambda: stream.connections == 2)
+    wait_until(lambda: cache.age("BTCUSDT") < cache.max_age and cache.get("BTCUSDT") == 41000)
+
+    assert fallback_calls == []